@@ -1,9 +1,16 @@
 #!/usr/bin/env python
 from threading import Thread
+import threading
 import socket
+import signal
 import time
 import sys
 import os
+import atexit
+import queue
+import heapq
+import itertools
+import collections
 from typing import Tuple
 
 # Config File
@@ -49,9 +56,12 @@ class config:
 		self.DROP_MODEL: int = 1 # Decides whether the drops are definite or dynamic
 		self.RANDOM_DROP_PROBABILITY: float = 0
 		self.REORDER_PROBABILITY: float = 0
+		self.SEED: int = None # Seeds the drop/reorder random streams, a fresh random seed every run when None
 
 # Emulator
 LOG_FILE_PATH = './emulator.log'
+METRICS_LOG_PATH = None	# CSV of queue lengths sampled every METRICS_INTERVAL secs, off when None
+METRICS_INTERVAL = 0.1
 HOST = ''
 PORT = '8001'
 nodes = None		# Dictionary to store the node information indexed by id
@@ -60,6 +70,8 @@ Config = None	   # Holds all the configuration information
 def read_config_file(path):
 	""" Reads the configuration file and sets parameters """
 	global LOG_FILE_PATH
+	global METRICS_LOG_PATH
+	global METRICS_INTERVAL
 	global PORT
 	global nodes
 	global Config
@@ -75,6 +87,8 @@ def read_config_file(path):
 	# Emulator
 	LOG_FILE_PATH = cfg.get("emulator", "log_file")
 	PORT = int(cfg.get("emulator", "port"))
+	METRICS_LOG_PATH = cfg.get("emulator", "metrics_log", fallback=None)
+	METRICS_INTERVAL = float(cfg.get("emulator", "metrics_interval", fallback=METRICS_INTERVAL))
 
 	# Network
 	Config = config()
@@ -84,6 +98,8 @@ def read_config_file(path):
 	Config.DROP_MODEL=int(cfg.get("network", "DROP_MODEL"))
 	Config.RANDOM_DROP_PROBABILITY=float(cfg.get("network", "RANDOM_DROP_PROBABILITY"))
 	Config.REORDER_PROBABILITY=float(cfg.get("network", "REORDER_PROBABILITY"))
+	seed = cfg.get("network", "SEED", fallback=None)
+	Config.SEED = int(seed) if seed else None
 	Config.MAX_PACKETS_QUEUED= int(2*Config.PROP_DELAY*(Config.LINK_BANDWIDTH/Config.MAX_PACKET_SIZE)) + 1 # The bandwidth delay product
 
 	print("Config Parsed: ", Config)
@@ -106,10 +122,68 @@ def read_config_file(path):
 # CONSTANTS AND HELPERS
 # ==========================================================================================================================================
 
+class LogSink:
+	"""
+	Appends log lines from a background thread instead of opening the log file on every call.
+	Lines wait in a bounded queue and are written in batches, one open per file per batch, at
+	least every FLUSH_INTERVAL seconds, on flush() and when the process exits. write() only
+	blocks when MAX_PENDING lines are already waiting.
+	"""
+	FLUSH_INTERVAL = 0.5
+	MAX_PENDING = 10000
+	_FLUSH = 'flush'
+
+	def __init__(self):
+		self._queue = queue.Queue(maxsize=self.MAX_PENDING)
+		self._thread = threading.Thread(target=self._run, daemon=True)
+		self._thread.start()
+		atexit.register(self.close)
+
+	def write(self, path, text):
+		self._queue.put((path, text))
+
+	def flush(self):
+		""" Blocks until every line written so far is in its file """
+		self._queue.put(self._FLUSH)
+		self._queue.join()
+
+	def close(self):
+		if self._thread.is_alive():
+			self._queue.put(None)
+			self._thread.join()
+
+	def _run(self):
+		running = True
+		while running:
+			# Wait for a line, then gather whatever else comes in until the flush deadline
+			items = [self._queue.get()]
+			deadline = time.time() + self.FLUSH_INTERVAL
+			while isinstance(items[-1], tuple):
+				try:
+					items.append(self._queue.get(timeout=max(deadline - time.time(), 0)))
+				except queue.Empty:
+					break
+			running = items[-1] is not None
+
+			files = {}
+			for item in items:
+				if isinstance(item, tuple):
+					files.setdefault(item[0], []).append(item[1])
+			for path, lines in files.items():
+				with open(path, 'a+') as f:
+					f.writelines(lines)
+			for _ in items:
+				self._queue.task_done()
+
+
+_log_sink = None
+
 def log(message):
-	""" Logs a message for the user """
-	with open(LOG_FILE_PATH, 'a+') as f:
-		f.write(f'{time.time()}\n{message}\n\n')
+	""" Logs a message for the user, off the packet forwarding thread through the LogSink """
+	global _log_sink
+	if _log_sink is None:
+		_log_sink = LogSink()
+	_log_sink.write(LOG_FILE_PATH, f'{time.time()}\n{message}\n\n')
 
 class Packet:
 	"""
@@ -157,10 +231,14 @@ class LatencyQueue:
 	latency is complete.
 
 	Latency queue is deterministic and only used to simulate wire latency. Does not impose any other constraints.
+	Packets are kept in a min-heap of (latency_complete_time, arrival count, packet) so the ready ones come off the
+	top in O(log n) each instead of scanning every packet in flight.
 	"""
 	def __init__(self, socketfd):
 		self._queue = []
+		self._count = itertools.count()	# Breaks ties between equal completion times in arrival order
 		self._sockfd = socketfd
+		self._wakeup = threading.Event()	# Set when a packet becomes the next one due, or on termination
 
 		# Start the incoming traffic count
 		self._in_traffic = 0.0
@@ -188,6 +266,7 @@ class LatencyQueue:
 				if packet.receiver_id() == 0:
 					log(f'Test Complete. Terminating...')
 					self.terminate = True
+					self._wakeup.set()
 					sys.exit()
 
 				if time.time() > self._last_recved:
@@ -200,7 +279,7 @@ class LatencyQueue:
 				# if drop_count:
 				# 	log(f'Dropped {drop_count} packet{"s" if drop_count > 1 else ""} due to full buffer.')
 				if packet.receiver_id() != PACKET_FAIL:		# Only admit packets with valid destinations
-					self._queue.append(packet)
+					self.put(packet)
 					self._total_bytes += len(data)
 			except Exception as e:
 				print('PROBLEM')
@@ -213,22 +292,32 @@ class LatencyQueue:
 		"""
 		return self._total_bytes/(time.time() - self._start_time)
 
+	def put(self, packet):
+		""" Enqueues a packet until its latency_complete_time """
+		heapq.heappush(self._queue, (packet.latency_complete_time, next(self._count), packet))
+		if self._queue[0][2] is packet:
+			self._wakeup.set()
+
+	def next_ready_time(self):
+		""" Returns the time the next packet completes its latency, None if the queue is empty """
+		return self._queue[0][0] if self._queue else None
+
+	def wait(self, timeout):
+		""" Blocks for up to timeout secs, returning early when a packet due sooner than the others arrives """
+		self._wakeup.wait(max(timeout, 0))
+		self._wakeup.clear()
+
 	def get_ready_packets(self):
 		"""
-		Returns the packets that have completed their latency.
-		Returns packets OUT OF ORDER-- if latency is variable, the packets are injected to sending buffer out of order
+		Returns the packets that have completed their latency, in order of completion time.
+		If latency is variable, packets are injected to the sending buffer in that order, not the order they arrived in
 		:return: List of packets ready
 		"""
 		ready = []
-		idx = 0
 		curtime = time.time()
-		while idx < len(self._queue):
-			if self._queue[idx].latency_complete_time < curtime:
-				packet = self._queue[idx]
-				#print(f'Latency done for #{packet_to_seq_num(packet)} -> {packet.receiver_id()}')
-				ready.append(self._queue.pop(idx))
-			else:
-				idx += 1
+		while self._queue and self._queue[0][0] < curtime:
+			ready.append(heapq.heappop(self._queue)[2])
+			#print(f'Latency done for #{packet_to_seq_num(ready[-1])} -> {ready[-1].receiver_id()}')
 		return ready
 
 
@@ -238,9 +327,16 @@ class SendingQueue:
 		Bandwidth limitations
 		Dropping
 		Reordering
+	Packets wait in a deque bounded at MAX_PACKETS_QUEUED, so taking the head is O(1) and a reordered packet is put
+	back at most 6 places in.
+	Drops and reorders draw from two random streams of their own, seeded from SEED and the destination. With a seed the
+	n-th packet sent to a destination meets the same fate on every run, whatever the traffic in the other direction.
 	"""
-	def __init__(self, socketfd):
-		self._queue = []
+	def __init__(self, socketfd, dest=None):
+		self._queue = collections.deque(maxlen=Config.MAX_PACKETS_QUEUED)
+		seeded = Config.SEED is not None
+		self._drop_rng = random.Random(f'{Config.SEED}/{dest}/drop' if seeded else None)
+		self._reorder_rng = random.Random(f'{Config.SEED}/{dest}/reorder' if seeded else None)
 		self._queuesize = 0
 		self._sockfd = socketfd
 		self._bandwidth_counter = 0
@@ -254,6 +350,12 @@ class SendingQueue:
 		# time.sleep(1/Config.LINK_BANDWIDTH)
 		return self._bandwidth_counter <= 0
 
+	def next_send_time(self):
+		""" Returns the time enough bandwidth is available to send the next packet, None if the queue is empty """
+		if not self._queue:
+			return None
+		return self._bandwidth_counter_update_time + max(self._bandwidth_counter, 0) / Config.LINK_BANDWIDTH
+
 	def get_next_packet(self):
 		"""
 		Selects the next packet to dequeue. Imposes bandwidth restrictions, reordering, dropping
@@ -269,7 +371,7 @@ class SendingQueue:
 		packet_drop = False
 
 		while self._queue and not next_packet:
-			next_packet = self._queue.pop(0)	# In-order Queue
+			next_packet = self._queue.popleft()	# In-order Queue
 
 			# if b'ACK' in next_packet.data:
 			# 	print('ACK found!\n')
@@ -282,9 +384,10 @@ class SendingQueue:
 				continue
 			
 			if len(self._queue) > 1 and self.reorder():
-				self._queue.insert(random.randint(1, min(len(self._queue)-1, 6)), next_packet)
-				log(f'Reordered Packet from {next_packet.addr} to index {self._queue.index(next_packet)}')
-				print(f'Redordered Packet from {next_packet.addr} to index {self._queue.index(next_packet)}')
+				idx = self._reorder_rng.randint(1, min(len(self._queue)-1, 6))
+				self._queue.insert(idx, next_packet)
+				log(f'Reordered Packet from {next_packet.addr} to index {idx}')
+				print(f'Redordered Packet from {next_packet.addr} to index {idx}')
 				next_packet = None
 				continue
 
@@ -305,12 +408,12 @@ class SendingQueue:
 		# For dynamic drop based on queue size
 		if Config.DROP_MODEL == 2:
 			mean = 2*(Config.PROP_DELAY + Config.MAX_PACKET_SIZE/Config.LINK_BANDWIDTH)*Config.LINK_BANDWIDTH
-			if random.gauss(mean, mean/3) < self._queuesize:
+			if self._drop_rng.gauss(mean, mean/3) < self._queuesize:
 				# Get a random sample from Normal Distribution.
 				# This is based on how full the current queue is.
 				return True
 		
-		elif Config.DROP_MODEL == 1 and random.uniform(0, 1) < Config.RANDOM_DROP_PROBABILITY < 1:
+		elif Config.DROP_MODEL == 1 and self._drop_rng.uniform(0, 1) < Config.RANDOM_DROP_PROBABILITY < 1:
 			return True
 		
 		else:
@@ -320,7 +423,7 @@ class SendingQueue:
 		"""
 		Decides if the next packet should be reordered with the given probability
 		"""
-		if random.uniform(0, 1) < Config.REORDER_PROBABILITY < 1:
+		if self._reorder_rng.uniform(0, 1) < Config.REORDER_PROBABILITY < 1:
 			return True
 		
 		else:
@@ -336,7 +439,6 @@ class SendingQueue:
 			return
 		for packet in packets:
 			drop_count = max(0, len(self._queue) + 1 - Config.MAX_PACKETS_QUEUED)
-			self._queue = self._queue[:Config.MAX_PACKETS_QUEUED]
 			if drop_count > 0:
 				log(f'Dropped {drop_count} packet{"s" if drop_count > 1 else ""} for {packet.receiver_id()} due to full buffer.')
 				print(f'Dropped {drop_count} packet{"s" if drop_count > 1 else ""} for {packet.receiver_id()} due to full buffer.')
@@ -366,6 +468,8 @@ class NetworkEmulator:
 		self.terminate = False
 		self.latency_queue = LatencyQueue(self.socketfd)
 		self.sending_buffers = {}
+		if METRICS_LOG_PATH:
+			self.metrics = MetricsSampler(self)
 
 	def bootstrap(self, host, port):
 		"""
@@ -401,12 +505,22 @@ class NetworkEmulator:
 		if dest is None:
 			return
 		if dest not in self.sending_buffers:
-			self.sending_buffers[dest] = SendingQueue(self.socketfd)
+			self.sending_buffers[dest] = SendingQueue(self.socketfd, dest)
 		self.sending_buffers[dest].add(packet)
 
+	def next_event_time(self):
+		"""
+		Returns the time something next needs doing: the earliest latency completion, the earliest time a non-empty
+		sending buffer has the bandwidth to send, or the next stats print
+		"""
+		events = [self.latency_queue.next_ready_time(), self._stat_time + STAT_INTERVAL]
+		events += [buffer.next_send_time() for buffer in self.sending_buffers.values()]
+		return min(t for t in events if t is not None)
+
 	def run(self):
 		"""
-		Infinite loop moves packets from the latency queue to the sending buffer, then sends ready packets from the sending buffer
+		Infinite loop moves packets from the latency queue to the sending buffer, then sends ready packets from the sending buffer.
+		Between passes it sleeps until the next event is due, or until a packet arrives that is due before it.
 		"""
 		while not self.terminate:
 			if self.latency_queue.terminate:
@@ -417,17 +531,48 @@ class NetworkEmulator:
 
 			for dest, buffer in self.sending_buffers.items():
 				to_send = buffer.get_next_packet()
-				if to_send:
+				while to_send:
 					addr = self.get_dest_address(to_send)
 					if addr is not None:
 						#print(f'Sending packet {packet_to_seq_num(to_send)} to id {dest}')
 						self.socketfd.sendto(to_send.data, addr)
+					to_send = buffer.get_next_packet()
 			
 			if (self._stat_time + STAT_INTERVAL) < time.time():
 				print(f'Current Average Incoming Traffic: {self.latency_queue.get_avg_traffic()} bytes/sec')
 				log(f'Current Average Incoming Traffic: {self.latency_queue.get_avg_traffic()} bytes/sec')
 				self._stat_time = time.time()
 
+			self.latency_queue.wait(self.next_event_time() - time.time())
+
+
+class MetricsSampler:
+	"""
+	Samples the emulator's queues every METRICS_INTERVAL seconds from a daemon thread and appends them to
+	METRICS_LOG_PATH as CSV: packets waiting out their latency, packets and bytes queued for each node and
+	the average incoming traffic.
+	"""
+	def __init__(self, emulator):
+		self.emulator = emulator
+		self.node_ids = sorted(nodes)
+		self._start_time = time.time()
+		with open(METRICS_LOG_PATH, 'w') as f:
+			fields = ['time', 'latency_queue'] + [f'queued_{id}' for id in self.node_ids] + ['queued_bytes', 'avg_traffic']
+			f.write(','.join(fields) + '\n')
+
+		th = Thread(target=self._run, daemon=True)
+		th.start()
+
+	def _run(self):
+		while True:
+			time.sleep(METRICS_INTERVAL)
+			buffers = dict(self.emulator.sending_buffers)
+			row = [round(time.time() - self._start_time, 6), len(self.emulator.latency_queue._queue)]
+			row += [len(buffers[id]._queue) if id in buffers else 0 for id in self.node_ids]
+			row += [sum(buffer._queuesize for buffer in buffers.values()), round(self.emulator.latency_queue.get_avg_traffic(), 2)]
+			with open(METRICS_LOG_PATH, 'a') as f:
+				f.write(','.join(str(v) for v in row) + '\n')
+
 
 # ==========================================================================================================================================
 # MAIN FUNCTION
@@ -439,5 +584,10 @@ if __name__ == '__main__':
 	assert len(sys.argv) == 2, 'Usage: python3 emulator.py <config_file_path>'
 	read_config_file(sys.argv[1])
 
+	# Exit cleanly on SIGTERM so the buffered log is flushed
+	signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
 	ne = NetworkEmulator(host=HOST, port=PORT, num_NODES=len(nodes))
+	start_wall, start_cpu = time.time(), time.process_time()
+	atexit.register(lambda: log(f'Emulator CPU time: {time.process_time() - start_cpu} secs over {time.time() - start_wall} secs'))
 	ne.run()
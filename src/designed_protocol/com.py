@@ -1,7 +1,73 @@
+import struct
+import sys
 import time
 
+# header formats, selected with `header_format` under [sender]
+FMT_TEXT   = 'text'
+FMT_BINARY = 'binary'
+
+# seq num, total packets, flags, send timestamp (usec, wraps at 2^32)
+HEADER = struct.Struct('!IIHI')
+
+# header flags, FLAG_LAST marks the last data packet
+FLAG_PARITY = 1 << 0
+FLAG_LAST   = 1 << 1
+
+# total of the packets cut before the sender knows how many there are, a
+# compressed stream is only sized once the whole file has been compressed
+TOTAL_UNKNOWN = 0xFFFFFFFF
+
+# teardown, the FIN is sent at most FIN_RETRIES times FIN_INTERVAL rtts apart
+# and the receiver keeps answering it for as long as the sender may retry
+FIN_RETRIES  = 3
+FIN_INTERVAL = 2
+
+# cumulative ack (lowest seq num not received), seq num that triggered the ack,
+# its echoed send timestamp, followed by a bitmap where bit i means seq num
+# cum+1+i has been received
+SACK_HEADER     = struct.Struct('!III')
+SACK_BITMAP_MAX = 32
+
+def header_size(fmt=FMT_BINARY) -> int:
+    if fmt == FMT_TEXT:
+        return len((str((sys.maxsize, sys.maxsize)) + '|').encode())
+    return HEADER.size
+
+def timestamp() -> int:
+    return int(time.time() * 1e6) & 0xFFFFFFFF
+
+def timestamp_age(ts:int) -> float:
+    """ seconds since an echoed timestamp was taken """
+    return ((timestamp() - ts) & 0xFFFFFFFF) / 1e6
+
+def format_ack(ack_num:int, ts_echo:int) -> bytes:
+    return f'{ack_num} {ts_echo}'.encode()
+
+def unformat_ack(data):
+    """ returns (seq num acked, echoed timestamp) """
+    ack_num, ts_echo = bytes(data).split(b' ')
+    return int(ack_num), int(ts_echo)
+
+def format_sack(cum:int, ack_num:int, ts_echo:int, bitmap:bytes) -> bytes:
+    return SACK_HEADER.pack(cum, ack_num, ts_echo) + bitmap[:SACK_BITMAP_MAX]
+
+def unformat_sack(data):
+    """ returns (cumulative ack, seq num that triggered the ack, echoed timestamp, [sacked seq nums]) """
+    cum, ack_num, ts_echo = SACK_HEADER.unpack_from(data)
+    sacked = []
+    for i, byte in enumerate(data[SACK_HEADER.size:]):
+        while byte:
+            low = byte & -byte
+            sacked.append(cum + 1 + i*8 + low.bit_length() - 1)
+            byte ^= low
+    return cum, ack_num, ts_echo, sacked
+
 class Packet():
-    def __init__(self, data, is_bytes=False):
+    def __init__(self, data, is_bytes=False, fmt=FMT_BINARY):
+        self.fmt   = fmt
+        self.flags = 0
+        self.ts    = 0
+        self.sends = 0
         if is_bytes:
             data = self.unformat(data)
         self.id    = data[0][0]
@@ -13,7 +79,14 @@ class Packet():
     def __lt__(self, other):
         return self.get_id() < other.get_id()
     def unformat(self, data):
-        data = data.split(b'|', maxsplit=1)
+        if self.fmt == FMT_TEXT:
+            return self.unformat_text(data)
+        # payload is a view into the datagram, no copy is made
+        view = memoryview(data)
+        seq, total, self.flags, self.ts = HEADER.unpack_from(view)
+        return [(seq, total), view[HEADER.size:]]
+    def unformat_text(self, data):
+        data = bytes(data).split(b'|', maxsplit=1)
         data[0] = list(map(int, (data[0]
                     .decode()
                     .replace(' ', '')
@@ -23,7 +96,10 @@ class Packet():
                     )))
         return data
     def format(self):
-        header = (str((self.id,self.total)) + '|').encode()
+        if self.fmt == FMT_TEXT:
+            header = (str((self.id,self.total)) + '|').encode()
+        else:
+            header = HEADER.pack(self.id, self.total, self.flags, self.ts)
         return header + self.data
     def get_age(self):
         return time.time() - self._time
@@ -0,0 +1,94 @@
+import lzma
+import struct
+import time
+import zlib
+
+RAW, ZLIB, LZMA = 0, 1, 2
+
+# every block goes out as (method, stored length, original length) + body
+FRAME = struct.Struct('!BII')
+
+CODECS = {
+    'zlib': (ZLIB, zlib.compress),
+    'lzma': (LZMA, lzma.compress),
+}
+DECODERS = {
+    ZLIB: zlib.decompress,
+    LZMA: lzma.decompress,
+}
+
+class Compressor():
+    """
+    Compresses a file in independent blocks of `block_sz` bytes. A block is
+    stored raw when compressing it saves less than MIN_SAVING of it, or when
+    it takes longer than sending the saved bytes at `bandwidth` bytes/sec
+    would. With method 'auto' the first block is compressed with every codec
+    and the one with the lowest compress plus send time is kept for the
+    whole transfer.
+    """
+    MIN_SAVING = 0.05
+
+    def __init__(self, method:str, bandwidth:float, block_sz:int=1 << 16):
+        if method != 'auto' and method not in CODECS:
+            raise ValueError(f'unknown compression {method}, pick one of auto, {", ".join(CODECS)}')
+        self.method       = method
+        self.bandwidth    = bandwidth
+        self.block_sz     = block_sz
+        self.n_blocks     = 0
+        self.n_compressed = 0
+        self.orig_size    = 0
+        self.size         = 0
+        self.time         = 0.0
+    def _try(self, name:str, block) -> tuple:
+        start = time.perf_counter()
+        body  = CODECS[name][1](block)
+        spent = time.perf_counter() - start
+        self.time += spent
+        return body, spent
+    def _pick(self, block) -> str:
+        costs = {}
+        for name in CODECS:
+            body, spent = self._try(name, block)
+            costs[name] = spent + len(body) / self.bandwidth
+        return min(costs, key=costs.get)
+    def frame(self, block) -> bytes:
+        if self.method == 'auto':
+            self.method = self._pick(block)
+        body, spent = self._try(self.method, block)
+        saved       = len(block) - len(body)
+        method      = CODECS[self.method][0]
+        if saved < self.MIN_SAVING * len(block) or spent > saved / self.bandwidth:
+            body, method = block, RAW
+        self.n_blocks     += 1
+        self.n_compressed += method != RAW
+        self.orig_size    += len(block)
+        self.size         += FRAME.size + len(body)
+        return FRAME.pack(method, len(body), len(block)) + body
+    def frames(self, f_name:str):
+        """ yields the framed blocks of the file in order, each read and compressed only once it is asked for """
+        with open(f_name, 'rb') as f:
+            for block in iter(lambda: f.read(self.block_sz), b''):
+                yield self.frame(block)
+
+class Decompressor():
+    """ Turns the framed stream, fed in order, back into the original bytes """
+    def __init__(self):
+        self._buf = bytearray()
+    def feed(self, data) -> bytes:
+        self._buf += data
+        out = bytearray()
+        pos = 0
+        while len(self._buf) - pos >= FRAME.size:
+            method, stored, orig = FRAME.unpack_from(self._buf, pos)
+            end = pos + FRAME.size + stored
+            if end > len(self._buf):
+                break
+            body = self._buf[pos + FRAME.size : end]
+            if method != RAW:
+                body = DECODERS[method](body)
+            if len(body) != orig:
+                raise ValueError(f'block decompressed to {len(body)} bytes, expected {orig}')
+            out += body
+            pos  = end
+        del self._buf[:pos]
+        return bytes(out)
@@ -0,0 +1,187 @@
+import abc
+import time
+
+class Congestion_control(abc.ABC):
+    """
+    Base congestion controller, windows are counted in packets. The sender
+    calls on_ack for every newly acked packet (rtt is None unless the ack
+    gave a clean sample), on_loss when a packet is fast retransmitted,
+    on_timeout when a retransmission timer fires and on_round once per rtt.
+    Only the first loss of a window reduces it, later ones up to `recover`
+    belong to the same congestion event. Controllers implement grow and
+    reduce, one that does not can not be constructed.
+    """
+    init_cwnd = 10
+
+    def __init__(self, mss:int, rtt:float, ppbw:float):
+        self.mss      = mss
+        self.ppbw     = ppbw
+        self.srtt     = rtt
+        self.min_rtt  = None
+        self.cwnd     = float(self.init_cwnd)
+        self.ssthresh = float('inf')
+        self.recover  = -1
+    def __repr__(self):
+        return f'{type(self).__name__}<cwnd={round(self.cwnd, 2)}, ssthresh={self.ssthresh}>'
+    def window(self) -> int:
+        return max(int(self.cwnd), 1)
+    def pacing_rate(self) -> float:
+        """ bytes/sec that spreads one window over one smoothed rtt """
+        return self.cwnd * self.mss / self.srtt
+    def on_ack(self, n:int, rtt:float):
+        if rtt is not None:
+            self.srtt    = 0.875 * self.srtt + 0.125 * rtt
+            self.min_rtt = rtt if self.min_rtt is None else min(self.min_rtt, rtt)
+        if n > self.recover:
+            self.grow(rtt)
+    def on_loss(self, n:int, highest_sent:int, in_flight:int):
+        if n <= self.recover:
+            return
+        self.recover = highest_sent
+        self.reduce(in_flight)
+    def on_timeout(self, n:int, highest_sent:int, in_flight:int):
+        if n > self.recover:
+            self.recover = highest_sent
+            self.reduce(in_flight)
+        self.cwnd = 1.0
+    def on_round(self, rtt:float):
+        pass
+    @abc.abstractmethod
+    def grow(self, rtt:float):
+        """ opens the window for one newly acked packet """
+    @abc.abstractmethod
+    def reduce(self, in_flight:int):
+        """ shrinks the window once per congestion event """
+
+class Legacy(Congestion_control):
+    """
+    The original custom scheme: start at the bandwidth delay product, and
+    once per rtt either double towards a threshold of rtt / 1.5 / ppbw
+    (capped at 1.25x the initial one) or add one packet above it. Losses
+    never shrink the window.
+    """
+    def __init__(self, mss:int, rtt:float, ppbw:float):
+        super().__init__(mss, rtt, ppbw)
+        self.cong_thresh     = int(rtt / ppbw)
+        self.cong_thresh_max = self.cong_thresh * 1.25
+        self.cwnd            = self.cong_thresh
+    def on_loss(self, n:int, highest_sent:int, in_flight:int):
+        pass
+    def on_timeout(self, n:int, highest_sent:int, in_flight:int):
+        pass
+    def grow(self, rtt:float):
+        pass
+    def reduce(self, in_flight:int):
+        pass
+    def on_round(self, rtt:float):
+        self.cong_thresh = int(min(rtt / 1.5 / self.ppbw, self.cong_thresh_max))
+        if self.cwnd >= self.cong_thresh:
+            self.cwnd += 1
+        else:
+            self.cwnd = min(self.cwnd * 2, self.cong_thresh)
+
+class New_reno(Congestion_control):
+    """ Slow start, then one packet per rtt, halving on loss (RFC 5681/6582) """
+    def grow(self, rtt:float):
+        if self.cwnd < self.ssthresh:
+            self.cwnd += 1
+        else:
+            self.cwnd += 1 / self.cwnd
+    def reduce(self, in_flight:int):
+        self.ssthresh = max(in_flight / 2, 2)
+        self.cwnd     = self.ssthresh
+
+class Cubic(Congestion_control):
+    """
+    CUBIC (RFC 8312): after a loss the window follows a cubic of the time
+    since the loss, plateauing around the window where the loss happened,
+    and never grows slower than an equivalent Reno flow.
+    """
+    C    = 0.4
+    BETA = 0.7
+
+    def __init__(self, mss:int, rtt:float, ppbw:float):
+        super().__init__(mss, rtt, ppbw)
+        self.w_max       = 0.0
+        self.w_last_max  = 0.0
+        self.w_est       = 0.0
+        self.k           = 0.0
+        self.epoch_start = None
+    def grow(self, rtt:float):
+        if self.cwnd < self.ssthresh:
+            self.cwnd += 1
+            return
+        now = time.time()
+        if self.epoch_start is None:
+            self.epoch_start = now
+            self.w_est       = self.cwnd
+            if self.w_max > self.cwnd:
+                self.k = ((self.w_max - self.cwnd) / self.C) ** (1/3)
+            else:
+                self.k, self.w_max = 0.0, self.cwnd
+        t      = now - self.epoch_start + (self.min_rtt or self.srtt)
+        target = self.w_max + self.C * (t - self.k) ** 3
+        self.w_est += 3 * (1 - self.BETA) / (1 + self.BETA) / self.cwnd
+        if target > self.cwnd:
+            self.cwnd += (target - self.cwnd) / self.cwnd
+        else:
+            self.cwnd += 0.01 / self.cwnd
+        self.cwnd = max(self.cwnd, self.w_est)
+    def reduce(self, in_flight:int):
+        # fast convergence, give up bandwidth faster while other flows grow
+        if self.cwnd < self.w_last_max:
+            self.w_last_max = self.cwnd
+            self.w_max      = self.cwnd * (1 + self.BETA) / 2
+        else:
+            self.w_last_max = self.w_max = self.cwnd
+        self.cwnd        = max(self.cwnd * self.BETA, 2)
+        self.ssthresh    = self.cwnd
+        self.epoch_start = None
+
+class Vegas(Congestion_control):
+    """
+    Delay based (TCP Vegas): once per rtt compare the expected throughput
+    at the minimum rtt with the actual one, and keep between ALPHA and BETA
+    packets queued at the bottleneck.
+    """
+    ALPHA = 2
+    BETA  = 4
+    GAMMA = 1
+
+    def __init__(self, mss:int, rtt:float, ppbw:float):
+        super().__init__(mss, rtt, ppbw)
+        self.round_min = None
+    def on_ack(self, n:int, rtt:float):
+        if rtt is not None:
+            self.round_min = rtt if self.round_min is None else min(self.round_min, rtt)
+        super().on_ack(n, rtt)
+    def grow(self, rtt:float):
+        if self.cwnd < self.ssthresh:
+            self.cwnd += 1
+    def on_round(self, rtt:float):
+        if self.round_min is None or self.min_rtt is None:
+            return
+        queued = self.cwnd * (1 - self.min_rtt / self.round_min)
+        self.round_min = None
+        if self.cwnd < self.ssthresh:
+            if queued > self.GAMMA:
+                self.ssthresh = self.cwnd = max(self.cwnd - queued, 2)
+        elif queued < self.ALPHA:
+            self.cwnd += 1
+        elif queued > self.BETA:
+            self.cwnd = max(self.cwnd - 1, 2)
+    def reduce(self, in_flight:int):
+        self.ssthresh = max(self.cwnd * 0.75, 2)
+        self.cwnd     = self.ssthresh
+
+CONTROLLERS = {
+    'legacy':  Legacy,
+    'newreno': New_reno,
+    'cubic':   Cubic,
+    'vegas':   Vegas,
+}
+
+def make_controller(name:str, mss:int, rtt:float, ppbw:float) -> Congestion_control:
+    if name not in CONTROLLERS:
+        raise ValueError(f'unknown congestion control {name}, pick one of {", ".join(CONTROLLERS)}')
+    return CONTROLLERS[name](mss, rtt, ppbw)
@@ -0,0 +1,95 @@
+import struct
+
+import numpy as np
+
+from com import Packet, FLAG_PARITY
+
+# each payload is prefixed with its length before coding, so a recovered
+# short last packet comes back at its real size
+LENGTH = struct.Struct('!H')
+
+# m has 4 bits in the flags, so a block gets at most 15 parity packets
+M_MAX = 0xF
+
+def parity_flags(m:int, j:int) -> int:
+    """ flags for parity packet j of m, m in bits 4-7 and j in bits 8-15 """
+    return FLAG_PARITY | (m << 4) | (j << 8)
+
+def unformat_flags(flags:int):
+    return (flags >> 4) & 0xF, (flags >> 8) & 0xFF
+
+def _stack(payloads:list, size:int) -> np.ndarray:
+    # rows are padded to a multiple of 8 bytes so they xor as uint64
+    width = -(-(size + LENGTH.size) // 8) * 8
+    block = np.zeros((len(payloads), width), dtype=np.uint8)
+    for row, data in zip(block, payloads):
+        row[:LENGTH.size] = np.frombuffer(LENGTH.pack(len(data)), dtype=np.uint8)
+        row[LENGTH.size:LENGTH.size + len(data)] = np.frombuffer(data, dtype=np.uint8)
+    return block.view(np.uint64)
+
+def encode(payloads:list, m:int) -> list:
+    """
+    Interleaved XOR parity: parity j covers the payloads i with i % m == j,
+    so a block can lose up to m packets as long as they fall in different
+    stripes.
+    """
+    size  = max(len(p) for p in payloads)
+    block = _stack(payloads, size)
+    return [np.bitwise_xor.reduce(block[j::m], axis=0).tobytes()[:LENGTH.size + size] for j in range(m)]
+
+def recover(parity:bytes, others:list) -> bytes:
+    """ rebuilds the one missing payload of a stripe from its parity and the rest """
+    rows = _stack([parity[LENGTH.size:]] + list(others), len(parity) - LENGTH.size)
+    data = np.bitwise_xor.reduce(rows, axis=0).view(np.uint8)
+    # the length prefix of the parity row is the xor of all the lengths,
+    # _stack wrote the parity's own payload length there instead
+    n    = LENGTH.unpack_from(parity)[0]
+    for p in others:
+        n ^= len(p)
+    return data[LENGTH.size:LENGTH.size + n].tobytes()
+
+class Fec_decoder():
+    """
+    Keeps the payloads and parity of every block that is still missing data,
+    and hands back packets rebuilt from a stripe with exactly one hole.
+    `have(n)` tells if seq num n already reached the writer.
+    """
+    def __init__(self, k:int, have, fmt):
+        self.k       = k
+        self.have    = have
+        self.fmt     = fmt
+        self._blocks = {}
+        self.n_recovered = 0
+    def _block(self, start:int):
+        return self._blocks.setdefault(start, ({}, {}))
+    def add_data(self, pkt:Packet) -> list:
+        start = pkt.id - pkt.id % self.k
+        data, parity = self._block(start)
+        # the payload may be a view into a receive buffer that gets reused
+        data[pkt.id] = bytes(pkt.data)
+        return self._decode(start, pkt.total)
+    def add_parity(self, pkt:Packet) -> list:
+        start = pkt.id
+        end   = min(start + self.k, pkt.total)
+        if all(self.have(n) for n in range(start, end)):
+            self._blocks.pop(start, None)
+            return []
+        m, j  = unformat_flags(pkt.flags)
+        data, parity = self._block(start)
+        parity[j] = (m, bytes(pkt.data))
+        return self._decode(start, pkt.total)
+    def _decode(self, start:int, total:int) -> list:
+        data, parity = self._blocks[start]
+        end       = min(start + self.k, total)
+        recovered = []
+        for j, (m, p) in parity.items():
+            stripe  = range(start + j, end, m)
+            missing = [n for n in stripe if n not in data]
+            if len(missing) == 1:
+                n       = missing[0]
+                data[n] = recover(p, [data[i] for i in stripe if i != n])
+                recovered.append(Packet(((n, total), data[n]), fmt=self.fmt))
+        self.n_recovered += len(recovered)
+        if len(data) == end - start:
+            del self._blocks[start]
+        return recovered
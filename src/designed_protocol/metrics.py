@@ -0,0 +1,45 @@
+import threading
+import time
+
+class Metrics_log(threading.Thread):
+    """
+    Calls `probe` every `interval` seconds from a daemon thread and appends
+    what it returns to a CSV, one row per sample with the seconds since the
+    start in the first column. probe returns a dict, the keys of the first
+    sample name the columns. stop() takes a last sample and closes the file.
+    """
+    def __init__(self, f_name:str, probe, interval:float=0.1):
+        super().__init__(daemon=True)
+        self.f_name   = f_name
+        self.probe    = probe
+        self.interval = interval
+        self._done    = threading.Event()
+        self._fields  = None
+        self._t0   = time.time()
+    def _row(self, f):
+        sample = self.probe()
+        if self._fields is None:
+            self._fields = list(sample)
+            f.write(','.join(['time'] + self._fields) + '\n')
+        row = [time.time() - self._t0] + [sample.get(k) for k in self._fields]
+        f.write(','.join('' if v is None else f'{v:.6g}' if isinstance(v, float) else str(v) for v in row) + '\n')
+    def run(self):
+        with open(self.f_name, 'w') as f:
+            while not self._done.wait(self.interval):
+                self._row(f)
+            self._row(f)
+    def stop(self):
+        self._done.set()
+        self.join()
+
+class Rate():
+    """ per second rate of a counter between two calls """
+    def __init__(self):
+        self._last = None
+    def __call__(self, count:int) -> float:
+        now = time.time()
+        rate = None
+        if self._last is not None and now > self._last[0]:
+            rate = (count - self._last[1]) / (now - self._last[0])
+        self._last = (now, count)
+        return rate
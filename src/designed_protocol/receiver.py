@@ -1,6 +1,8 @@
 #!/usr/bin/env python3
 
 import argparse
+import hashlib
+import os
 import socket
 import threading
 import time
@@ -8,81 +10,210 @@ import copy
 
 import configparser
 
-from monitor import Monitor, format_packet
-from com     import Packet
+from monitor import Monitor, BufferPool, MAX_HEADER_OVERHEAD, file_digest, format_packet, log
+from com     import Packet, FMT_BINARY, FLAG_PARITY, FLAG_LAST, TOTAL_UNKNOWN, SACK_BITMAP_MAX, FIN_RETRIES, FIN_INTERVAL, format_ack, format_sack
+from compress import Decompressor
+from metrics  import Metrics_log, Rate
+
+START_TIME = time.time()
+
+class Recv_bitmap():
+    """
+    Receive state as a bitmap that slides along with the cumulative ack,
+    bit i is seq num base + i. Bytes below the cumulative ack are dropped
+    once COMPACT of them pile up, so memory follows the reordering span
+    rather than the file size.
+    """
+    COMPACT = 4096
+
+    def __init__(self):
+        self._bits   = bytearray()
+        self._base   = 0
+        self.cum     = 0    # lowest seq num not received
+        self.highest = -1
+    def __contains__(self, n:int) -> bool:
+        if n < self.cum:
+            return True
+        i = n - self._base
+        return (i >> 3) < len(self._bits) and bool(self._bits[i >> 3] >> (i & 7) & 1)
+    def add(self, n:int) -> bool:
+        """ marks seq num n as received, False if it already was """
+        if n < self.cum:
+            return False
+        bits = self._bits
+        i    = n - self._base
+        byte = i >> 3
+        bit  = 1 << (i & 7)
+        if byte >= len(bits):
+            bits.extend(bytes(byte + 1 - len(bits)))
+        elif bits[byte] & bit:
+            return False
+        bits[byte] |= bit
+        if n > self.highest:
+            self.highest = n
+        if n == self.cum:
+            self._advance()
+        return True
+    def _advance(self):
+        bits = self._bits
+        i    = self.cum - self._base
+        end  = len(bits) * 8
+        while i < end:
+            if (i & 7) == 0 and bits[i >> 3] == 0xFF:
+                i += 8
+            elif bits[i >> 3] >> (i & 7) & 1:
+                i += 1
+            else:
+                break
+        self.cum = self._base + i
+        if (i >> 3) >= self.COMPACT:
+            del bits[:i >> 3]
+            self._base += (i >> 3) * 8
+    def bitmap(self, start:int, n_bits:int) -> bytes:
+        """ n_bits bits for the seq nums from start (at or above the cumulative ack) on """
+        if n_bits <= 0:
+            return b''
+        i    = start - self._base
+        word = int.from_bytes(self._bits[i >> 3 : ((i + n_bits) >> 3) + 1], 'little') >> (i & 7)
+        return (word & ((1 << n_bits) - 1)).to_bytes((n_bits + 7) // 8, 'little')
 
 class Writer(threading.Thread):
-    def __init__(self, f_name):
+    """
+    Writes every packet at its offset in the output file with os.pwrite as
+    soon as it arrives, so nothing waits in memory for a gap to fill. The
+    offset is the packet's seq num times the payload size, learned from the
+    first packet that is not the last one, and the file is preallocated as
+    soon as that size is known. The thread sleeps on a condition variable
+    until packets are queued. A compressed stream can only be decoded in
+    order, so with `decompress` packets are held until the gap below them
+    fills and the decoded output is appended. `digest` is a BLAKE2b hash of
+    the file extended as it is written, read back from the page cache up to
+    the first gap.
+    """
+    def __init__(self, f_name, decompress:bool=False, pool:BufferPool=None):
         super().__init__()
+        self._decoder      = Decompressor() if decompress else None
+        self._pool         = pool
         self._packets      = {}
         self._packets_lock = threading.Lock()
+        self._cond         = threading.Condition(self._packets_lock)
+        self._queue        = []
+        self._held         = []
         self._stay_alive   = threading.Event()
         self._f_name       = f_name
+        self._fd           = None
+        self._written      = Recv_bitmap()
+        self._hashed       = 0
+        self._size         = None
+        self.digest        = hashlib.blake2b()
+        self.chunk_sz      = None
+        self.total         = None
+        self.n_written     = 0
         self.pkt_curr      = 0
-        self.curr_spin     = False
-        self.to_push       = None
+        self.received      = Recv_bitmap()
+    @property
+    def cum_ack(self) -> int:
+        return self.received.cum
+    @property
+    def highest(self) -> int:
+        return self.received.highest
     def run(self):
         self._stay_alive.set()
-        open(self._f_name, 'wb').close()
+        self._fd = os.open(self._f_name, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
         try:
-            while self._stay_alive.is_set():
-                total    = 9999
-                do_write = False
-                data = None
-                pkt = self.packets_pop(self.pkt_curr)
-                while pkt:
-                    self.curr_spin = True
-                    self.pkt_curr += 1
-                    do_write = True
-                    total = pkt.total
-                    if data == None:
-                        data = pkt.data
-                    else:
-                        data += pkt.data
-                    pkt = self.packets_pop(self.pkt_curr)
-                
-                self.curr_spin = False
-                if do_write:
-                    # print(f'writing -> {self.pkt_curr}/{total}')
-                    with open(self._f_name, 'ab') as f:
-                        f.write(data)
-                    
-                if self.pkt_curr == total and self.packets_size() == 0:
-                    print(f'killing at {self.pkt_curr}/{total}')
-                    self.kill()
-                    
+            while self.n_written != self.total:
+                with self._cond:
+                    while not self._queue and self._stay_alive.is_set():
+                        self._cond.wait()
+                    if not self._queue:
+                        break
+                    pkts, self._queue = self._queue, []
+                if self._decoder:
+                    self.write_in_order(pkts)
+                else:
+                    self.write(pkts)
+            print(f'writer done at {self.n_written}/{self.total}')
         except KeyboardInterrupt:
             print('keyboard interrupt in writer loop'.upper())
+        finally:
+            os.close(self._fd)
             self.kill()
+    def write(self, pkts:list):
+        # the last packet can show up before the payload size is known
+        if self.chunk_sz is None:
+            self._held += pkts
+            return
+        if self._held is not None:
+            self.preallocate()
+            pkts, self._held = self._held + pkts, None
+        for pkt in pkts:
+            os.pwrite(self._fd, pkt.data, pkt.id * self.chunk_sz)
+            if pkt.id == pkt.total - 1:
+                self._size = pkt.id * self.chunk_sz + len(pkt.data)
+                os.ftruncate(self._fd, self._size)
+            self._written.add(pkt.id)
+        self.n_written += len(pkts)
+        self.release(pkts)
+        self.hash_written()
+    def hash_written(self):
+        end = self._size if self._written.cum == self.total else self._written.cum * self.chunk_sz
+        while self._hashed < end:
+            chunk = os.pread(self._fd, min(end - self._hashed, 1 << 20), self._hashed)
+            self.digest.update(chunk)
+            self._hashed += len(chunk)
+    def write_in_order(self, pkts:list):
+        for pkt in pkts:
+            self._packets[pkt.id] = pkt
+        run = []
+        while self.pkt_curr in self._packets:
+            run.append(self._packets.pop(self.pkt_curr))
+            self.pkt_curr += 1
+        if run:
+            data = self._decoder.feed(b''.join(pkt.data for pkt in run))
+            self.digest.update(data)
+            os.write(self._fd, data)
+            self.n_written += len(run)
+            self.release(run)
+    def preallocate(self):
+        size = self.total * self.chunk_sz
+        if hasattr(os, 'posix_fallocate'):
+            os.posix_fallocate(self._fd, 0, size)
+        else:
+            os.ftruncate(self._fd, size)
+    def depth(self) -> int:
+        """ packets held in memory, queued for writing or waiting for a gap to fill """
+        return len(self._queue) + len(self._held or ()) + len(self._packets)
     def kill(self):
-        self._stay_alive.clear()  
-    def packets_pop(self, n:int) -> Packet:
-        val = None
-        with self._packets_lock:
-            if n in self._packets:
-                val = self._packets.pop(n)
-        return val
+        with self._cond:
+            self._stay_alive.clear()
+            self._cond.notify()
+    def release(self, pkts:list):
+        """ hands the receive buffers behind the payloads back to the pool """
+        if self._pool:
+            for pkt in pkts:
+                if isinstance(pkt.data, memoryview):
+                    self._pool.put(pkt.data)
     def packets_push(self, packet: Packet):
-        if self.to_push == None:
-            self.to_push = set(list(range(packet.total)))
+        if self.total is None and packet.total != TOTAL_UNKNOWN:
+            self.total = packet.total
         pushed = 0
-        with self._packets_lock:
-            if (packet.id in self.to_push) and (packet.id not in self._packets):
-                self.to_push.remove(packet.id)
+        with self._cond:
+            if packet.id < packet.total and self.received.add(packet.id):
                 pushed = 1
-                self._packets[packet.id] = packet
+                if self.chunk_sz is None and (packet.id < packet.total - 1 or packet.total == 1):
+                    self.chunk_sz = len(packet.data)
+                self._queue.append(packet)
+                self._cond.notify()
         return pushed
-    def packets_size(self) -> int:
+    def sack(self):
+        """ returns the cumulative ack and a bitmap of the seq nums received above it """
         with self._packets_lock:
-            sz = len(self._packets)
-        return sz
-    def packets_curr(self):
-        while self.curr_spin and self._stay_alive.is_set():
-            pass    
+            cum    = self.received.cum
+            bitmap = self.received.bitmap(cum + 1, min(self.received.highest - cum, SACK_BITMAP_MAX * 8))
+        return cum, bitmap
+    def has(self, n:int) -> bool:
         with self._packets_lock:
-            curr = self.pkt_curr
-            sz   = len(self._packets)
-        return curr, sz
+            return n in self.received
 
 class Receiver(Monitor, threading.Thread):
     def __init__(self, cfg_path):
@@ -93,46 +224,191 @@ class Receiver(Monitor, threading.Thread):
         self.send_id       = int(cfg.get('sender', 'id'))
         self.out_file      = cfg.get('receiver', 'write_location')
         self.window_sz     = int(cfg.get('sender',   'window_size'))
+        self.header_fmt    = cfg.get('sender', 'header_format', fallback=FMT_BINARY)
+        self.ack_every     = int(cfg.get('receiver', 'ack_every', fallback='1'))
+        # coalesced acks are only meaningful as cumulative (sack) acks
+        self.send_sacks    = int(cfg.get('receiver', 'send_sacks', fallback='0')) == 1 or self.ack_every > 1
+        self.ack_pending   = 0
+        self.ack_pkt       = None
+        self.ack_deadline  = None
         self.timeout       = (self.Config.MAX_PACKET_SIZE / self.Config.LINK_BANDWIDTH) + 2 * float(cfg.get('network', 'PROP_DELAY'))
+        # a coalesced ack is held back a quarter rtt at most, like a delayed
+        # ack timer. 0 sends every ack right away and so coalesces nothing
+        self.ack_delay     = float(cfg.get('receiver', 'ack_delay', fallback=str(self.timeout / 4)))
         self._stay_alive   = threading.Event()
-        self.writer        = Writer(self.out_file)
+        # datagrams are read into pooled buffers, a window worth of them
+        # covers the packets waiting in the writer
+        self.pool          = BufferPool(self.Config.MAX_PACKET_SIZE + MAX_HEADER_OVERHEAD, 2 * self.window_sz)
+        self.writer        = Writer(self.out_file, cfg.get('sender', 'compression', fallback='off') != 'off', self.pool)
+        # the original is hashed while the transfer runs, so verifying the
+        # received file adds no tail
+        self.orig_digest   = None
+        self.orig_hasher   = threading.Thread(target=self.hash_original, daemon=True)
+        self.orig_hasher.start()
+        self.total         = None
+        self.n_received    = 0
+        self.n_acks        = 0
+        self.metrics       = None
+        if cfg.get('receiver', 'metrics_log', fallback=None):
+            self.pkt_rate  = Rate()
+            self.metrics   = Metrics_log(cfg.get('receiver', 'metrics_log'), self.probe,
+                                         float(cfg.get('receiver', 'metrics_interval', fallback='0.1')))
         self.writer.start()
+        self.fec           = None
+        if int(cfg.get('sender', 'fec', fallback='0')) == 1:
+            if self.header_fmt != FMT_BINARY:
+                raise ValueError('fec needs header_format=binary to flag parity packets')
+            # numpy is only needed with fec on
+            from fec import Fec_decoder
+            self.fec       = Fec_decoder(int(cfg.get('sender', 'fec_k', fallback='16')), self.writer.has, self.header_fmt)
     def __str__(self, blocking=True):
         msg = f'Reciever:\n  '
         msg += '\n  '.join([f'{k} == {v}' for (k,v) in self.__dict__.items()])
         return msg
 
+    def hash_original(self):
+        self.orig_digest = file_digest(self.file)
+
+    def probe(self) -> dict:
+        return {
+            'received':     self.n_received,
+            'recv_rate':    self.pkt_rate(self.n_received),
+            'cum_ack':      self.writer.cum_ack,
+            'reorder_span': max(self.writer.highest + 1 - self.writer.cum_ack, 0),
+            'writer_depth': self.writer.depth(),
+            'acks_sent':    self.n_acks,
+        }
+
+    def send_ack(self, pkt:Packet):
+        if self.send_sacks:
+            cum, bitmap = self.writer.sack()
+            ack_bytes   = format_sack(cum, pkt.id, pkt.ts, bitmap)
+        else:
+            ack_bytes   = format_ack(pkt.id, pkt.ts)
+        self.send(self.send_id, ack_bytes)
+        self.n_acks += 1
+
+    def queue_ack(self, pkt:Packet, pushed:int):
+        """
+        Holds back the ack for in order packets until ack_every of them have
+        arrived or ack_delay has passed. Out of order packets and duplicates
+        are acked right away so the sender learns about holes quickly.
+        """
+        in_order = pushed and (self.writer.cum_ack == pkt.id + 1) and (self.writer.highest == pkt.id)
+        if not in_order:
+            self.ack_pending = 0
+            self.ack_deadline = None
+            self.send_ack(pkt)
+            return
+        self.ack_pkt      = pkt
+        self.ack_pending += 1
+        if self.ack_deadline is None:
+            self.ack_deadline = time.time() + self.ack_delay
+        if self.ack_pending >= self.ack_every or self.ack_delay <= 0:
+            self.flush_ack()
+
+    def flush_ack(self):
+        if self.ack_pending > 0:
+            self.send_ack(self.ack_pkt)
+        self.ack_pending  = 0
+        self.ack_deadline = None
+
+    def ack_wait(self):
+        if self.ack_deadline is None:
+            return None
+        return max(self.ack_deadline - time.time(), 1e-4)
+
+    def learn_total(self, pkt:Packet):
+        """
+        Packets of a compressed stream cut before the sender got to its end
+        carry TOTAL_UNKNOWN. The total comes with the flagged last packet or
+        any packet sent after it, and is filled into every packet from then on.
+        """
+        if self.total is None:
+            if pkt.flags & FLAG_LAST:
+                self.total = pkt.id + 1
+            elif pkt.total != TOTAL_UNKNOWN:
+                self.total = pkt.total
+        if self.total is not None:
+            pkt.total = self.total
+
+    def handle_packet(self, pkt:Packet) -> int:
+        """ hands a data or parity packet to the writer, returns the number of new packets """
+        self.learn_total(pkt)
+        if pkt.flags & FLAG_PARITY:
+            pushed  = 0
+            decoded = self.fec.add_parity(pkt) if self.fec else []
+        else:
+            pushed  = self.writer.packets_push(pkt)
+            self.queue_ack(pkt, pushed)
+            decoded = self.fec.add_data(pkt) if (self.fec and pushed) else []
+        # the writer owns the buffer of a packet it took, nobody else does
+        if not pushed:
+            self.writer.release([pkt])
+        # packets rebuilt from parity are acked like any other arrival
+        for rec in decoded:
+            rec_pushed = self.writer.packets_push(rec)
+            pushed    += rec_pushed
+            self.queue_ack(rec, rec_pushed)
+        return pushed
+
     def run(self):
         self._stay_alive.set()
-        packets_recieved = 0
+        cpu_start = time.process_time()
+        if self.metrics:
+            self.metrics.start()
+        done         = False
+        fin_deadline = None
         while self._stay_alive.is_set():
-            try:
-                recv_sender, recv_data = self.recv(self.Config.MAX_PACKET_SIZE)
-                if recv_sender == self.send_id:
-                    pkt = Packet(recv_data, is_bytes=True)
-                    packets_recieved += self.writer.packets_push(pkt)
-                    ack_bytes = f'{pkt.id}'.encode() 
-                    self.send(self.send_id, ack_bytes)
-
-                if packets_recieved == pkt.total:
-                    self.recv_end(self.out_file, self.send_id)
+            # once everything is written only the sender's FIN is left to
+            # wait for, giving up after the old linger window. After the FIN
+            # is acked the receiver stays in TIME_WAIT until the sender is
+            # past its last retry, in case the ack got lost
+            if fin_deadline is not None:
+                if time.time() >= fin_deadline:
                     self.kill()
-            except socket.timeout:
-                print('timeout occurred in reciever')
-        
-        # hang out for any missed packets in the end
-        start_time = time.time()
-        timeout   = self.timeout * self.window_sz
-        self.socketfd.settimeout(timeout)
-        while time.time() - start_time < timeout:
+                    break
+                self.socketfd.settimeout(fin_deadline - time.time())
+            else:
+                self.socketfd.settimeout(self.timeout * self.window_sz if done else self.ack_wait())
             try:
-                recv_sender, recv_data = self.recv(self.Config.MAX_PACKET_SIZE)
-                pkt = Packet(recv_data, is_bytes=True)
-                ack_bytes = f'{pkt.id}'.encode() 
-                self.send(self.send_id, ack_bytes)
-                start_time = time.time()
+                for recv_sender, recv_data in self.recv_many(self.window_sz, pool=self.pool):
+                    if recv_sender != self.send_id:
+                        self.pool.put(recv_data)
+                        continue
+                    pkt = Packet(recv_data, is_bytes=True, fmt=self.header_fmt)
+                    if not isinstance(pkt.data, memoryview):
+                        # the text header parser already copied the payload out
+                        self.pool.put(recv_data)
+                    if pkt.id == pkt.total:
+                        self.writer.release([pkt])
+                        if done:
+                            self.send_ack(pkt)
+                            fin_deadline = time.time() + FIN_RETRIES * FIN_INTERVAL * self.timeout
+                        continue
+                    self.n_received += self.handle_packet(pkt)
+
+                    if self.n_received == self.total and not done:
+                        done = True
+                        self.flush_ack()
+                        if self.metrics:
+                            self.metrics.stop()
+                        # the writer is done once the last queued packet is on disk
+                        self.writer.join()
+                        self.orig_hasher.join()
+                        self.recv_end(self.out_file, self.send_id, self.writer.digest.digest(), self.orig_digest)
+                        cpu_time = time.process_time() - cpu_start
+                        log(self.LOG_FILE_PATH, f'CPU Time					: {round(cpu_time, 3)} secs')
+                        log(self.LOG_FILE_PATH, f'CPU Time per MB			: {round(cpu_time / max(os.path.getsize(self.file) / 1e6, 1e-6), 3)} secs')
+                        if self.fec:
+                            log(self.LOG_FILE_PATH, f'FEC Recovered Packets		: {self.fec.n_recovered}')
             except socket.timeout:
-                break
+                if done and fin_deadline is None:
+                    print('no FIN from the sender, closing')
+                    self.kill()
+                # the delayed ack timer fired
+                self.flush_ack()
+        log(self.LOG_FILE_PATH, f'Process Lifetime			: {round(time.time() - START_TIME, 3)} secs')
 
     def kill(self):
         self._stay_alive.clear()  
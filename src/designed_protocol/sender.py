@@ -1,222 +1,787 @@
 #!/usr/bin/env python3
 
 import argparse
-import socket
+import collections
+import heapq
 import os
 import math
-import sys
+import mmap
+import selectors
 import time
-from collections import OrderedDict
 
 import configparser
 
 import threading
-from multiprocessing import Process, Queue
-from multiprocessing.managers import BaseManager
 
-from monitor import Monitor, format_packet
-from com     import Packet
-
-class Ack_buff():
-    def __init__(self):
-        self._packets = OrderedDict()
-        self._lock = threading.Lock()
+from monitor import Monitor, format_packet, log
+from com     import (Packet, FMT_BINARY, FLAG_LAST, TOTAL_UNKNOWN, FIN_RETRIES, FIN_INTERVAL, header_size,
+                     timestamp, timestamp_age, unformat_ack, unformat_sack)
+from congestion import make_controller
+from compress   import Compressor
+from metrics    import Metrics_log, Rate
+
+START_TIME = time.time()
+
+class Send_window():
+    """
+    Buffer of unacked packets. They sit in a ring indexed by sequence number,
+    so push, remove and the oldest unacked lookup are O(1). get() without an
+    id returns the packet under a cursor that cycle() moves along.
+    """
+    def __init__(self, capacity:int=64):
+        capacity     = 1 << max(capacity - 1, 1).bit_length()
+        self._slots  = [None] * capacity
+        self._mask   = capacity - 1
+        self._base   = 0    # lowest unacked seq num
+        self._end    = 0    # one past the highest pushed seq num
+        self._cursor = 0
+        self._size   = 0
+        self._lock   = threading.Lock()
+    def _grow(self, need:int):
+        capacity = 1 << (need - 1).bit_length()
+        slots    = [None] * capacity
+        for n in range(self._base, self._end):
+            slots[n & (capacity - 1)] = self._slots[n & self._mask]
+        self._slots = slots
+        self._mask  = capacity - 1
+    def _slot(self, n:int) -> Packet:
+        if self._base <= n < self._end:
+            return self._slots[n & self._mask]
+        return None
+    def _next_live(self, n:int) -> int:
+        # first live seq num at or after n, wrapping back to the base
+        if n < self._base or n >= self._end:
+            n = self._base
+        while self._slots[n & self._mask] is None:
+            n += 1
+            if n >= self._end:
+                n = self._base
+        return n
     def pop(self) -> Packet:
         val = None
         with self._lock:
-            if len(self._packets) > 0:
-                val = self._packets.popitem(last=True)[1]
+            if self._size > 0:
+                n = self._end - 1
+                while self._slots[n & self._mask] is None:
+                    n -= 1
+                val = self._remove(n)
         return val
     def get(self, id=None):
-        val = None
         with self._lock:
-            if len(self._packets) > 0:
-                if id != None:
-                    val = self._packets.get(id, None)
-                elif len(self._packets) > 0:
-                    val = next(iter(self._packets.values()))
-
-            return val
+            if self._size == 0:
+                return None
+            if id != None:
+                return self._slot(id)
+            self._cursor = self._next_live(self._cursor)
+            return self._slots[self._cursor & self._mask]
+    def oldest(self) -> Packet:
+        with self._lock:
+            return self._slots[self._base & self._mask] if self._size > 0 else None
     def push(self, packet: Packet):
+        n = packet.get_id()
         with self._lock:
-            self._packets[packet.get_id()] = packet
+            if self._size == 0:
+                self._base = self._end = self._cursor = n
+            elif n < self._base:
+                return
+            if n - self._base >= len(self._slots):
+                self._grow(n - self._base + 1)
+            if self._slots[n & self._mask] is None:
+                self._size += 1
+            self._slots[n & self._mask] = packet
+            self._end = max(self._end, n + 1)
     def size(self) -> int:
-        with self._lock:
-            sz = len(self._packets)
-        return sz
+        return self._size
     def remove(self, packet_num:int):
-        # print(f'removing {packet_num}')
         with self._lock:
-            del_pkt  = self._packets.pop(packet_num, None)
-        return del_pkt
-
+            return self._remove(packet_num)
+    def _remove(self, n:int):
+        pkt = self._slot(n)
+        if pkt is None:
+            return None
+        self._slots[n & self._mask] = None
+        self._size -= 1
+        if self._size == 0:
+            self._base = self._end
+        elif n == self._base:
+            while self._slots[self._base & self._mask] is None:
+                self._base += 1
+        return pkt
     def cycle(self):
         with self._lock:
-            if len(self._packets) > 0:
-                pkt = next(iter(self._packets.values()))
-                self._packets.move_to_end(pkt.get_id(), last=True)
+            if self._size > 0:
+                self._cursor = self._next_live(self._next_live(self._cursor) + 1)
+
+class Retx_timers():
+    """
+    Retransmission deadlines kept in a min-heap. Re-arming or cancelling a
+    seq num only updates the live deadline, stale heap entries are skipped
+    when they surface, so expired() costs O(expired log n).
+    """
+    def __init__(self):
+        self._heap     = []
+        self._deadline = {}
+    def __len__(self):
+        return len(self._deadline)
+    def arm(self, n:int, deadline:float):
+        self._deadline[n] = deadline
+        heapq.heappush(self._heap, (deadline, n))
+    def cancel(self, n:int):
+        self._deadline.pop(n, None)
+    def _discard_stale(self):
+        while self._heap and self._deadline.get(self._heap[0][1]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+    def next_deadline(self) -> float:
+        self._discard_stale()
+        return self._heap[0][0] if self._heap else None
+    def expired(self, now:float) -> list:
+        fired = []
+        self._discard_stale()
+        while self._heap and self._heap[0][0] <= now:
+            deadline, n = heapq.heappop(self._heap)
+            del self._deadline[n]
+            fired.append(n)
+            self._discard_stale()
+        return fired
+
+class Rtt_estimator():
+    """
+    RFC 6298 retransmission timeout: smoothed rtt and rtt variance from
+    clean samples, exponential backoff on timeouts until the next sample.
+    srtt and rttvar take one sample per srtt, the way a single timed packet
+    per round would. Back to back samples from one window hardly differ and
+    would drive rttvar to nothing. `margin` is the floor of the variance
+    term (G in the RFC). Keeps (time, srtt, rttvar, rto, min_rtt) rows when
+    `history` is set.
+    """
+    ALPHA = 1/8
+    BETA  = 1/4
+    K     = 4
+
+    def __init__(self, init_rto:float, min_rto:float, margin:float, max_rto:float=10.0, history:bool=False):
+        self.G       = margin
+        self.srtt    = None
+        self.rttvar  = None
+        self.min_rtt = None
+        self.rto     = init_rto
+        self.min_rto = min_rto
+        self.max_rto = max_rto
+        self.history = [] if history else None
+        self._next_sample = 0.0
+    def __repr__(self):
+        return f'Rtt_estimator<srtt={self.srtt}, rttvar={self.rttvar}, rto={self.rto}>'
+    def update(self, rtt:float):
+        self.min_rtt = rtt if self.min_rtt is None else min(self.min_rtt, rtt)
+        now = time.time()
+        if now < self._next_sample:
+            return
+        if self.srtt is None:
+            self.srtt   = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = (1 - self.BETA) * self.rttvar + self.BETA * abs(self.srtt - rtt)
+            self.srtt   = (1 - self.ALPHA) * self.srtt + self.ALPHA * rtt
+        self._next_sample = now + self.srtt
+        self.rto     = min(max(self.srtt + max(self.G, self.K * self.rttvar), self.min_rto), self.max_rto)
+        self.record()
+    def backoff(self):
+        self.rto = min(self.rto * 2, self.max_rto)
+        self.record()
+    def record(self):
+        if self.history is not None:
+            self.history.append((time.time(), self.srtt, self.rttvar, self.rto, self.min_rtt))
+    def export(self, f_name:str):
+        with open(f_name, 'w') as f:
+            f.write('time,srtt,rttvar,rto,min_rtt\n')
+            for row in self.history:
+                f.write(','.join('' if v is None else f'{v:.6f}' for v in row) + '\n')
+
+class Pacer():
+    """
+    Token bucket that spreads transmissions out at `rate` bytes/sec with
+    bursts of at most `burst` bytes, instead of dumping a whole window onto
+    the link at once.
+    """
+    def __init__(self, rate:float, burst:int):
+        self.rate    = rate
+        self.burst   = burst
+        self._tokens = burst
+        self._last   = time.time()
+    def _refill(self):
+        now          = time.time()
+        self._tokens = min(self._tokens + (now - self._last) * self.rate, self.burst)
+        self._last   = now
+    def ready(self, n_bytes:int) -> bool:
+        self._refill()
+        return self._tokens >= n_bytes
+    def consume(self, n_bytes:int):
+        self._refill()
+        self._tokens -= n_bytes
+    def wait_time(self, n_bytes:int) -> float:
+        self._refill()
+        return max(n_bytes - self._tokens, 0) / self.rate
+
+class Chunker():
+    """
+    Lazily hands out packet payloads as memoryview slices of an mmap of the
+    file. Pages below the lowest unacked chunk are released back to the OS.
+    """
+    def __init__(self, f_name, chunk_sz:int):
+        self.chunk_sz  = chunk_sz
+        self.size      = os.path.getsize(f_name)
+        self.total     = math.ceil(self.size / chunk_sz)
+        self.next_id   = 0
+        self._f        = open(f_name, 'rb')
+        self._mm       = None
+        self._view     = memoryview(b'')
+        if self.size > 0:
+            self._mm   = mmap.mmap(self._f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._view = memoryview(self._mm)
+        self._acked    = set()
+        self._floor    = 0
+        self._released = 0
+    def __len__(self):
+        return self.total - self.next_id
+    def get(self, n:int) -> memoryview:
+        return self._view[n * self.chunk_sz : (n+1) * self.chunk_sz]
+    def next(self):
+        if self.next_id >= self.total:
+            return None
+        n = self.next_id
+        self.next_id += 1
+        return n, self.get(n)
+    def release(self, n:int):
+        self._acked.add(n)
+        floor = self._floor
+        while floor in self._acked:
+            self._acked.remove(floor)
+            floor += 1
+        if floor == self._floor:
+            return
+        self._floor = floor
+        end = (floor * self.chunk_sz) // mmap.PAGESIZE * mmap.PAGESIZE
+        if self._mm and hasattr(self._mm, 'madvise') and end > self._released:
+            self._mm.madvise(mmap.MADV_DONTNEED, self._released, end - self._released)
+            self._released = end
+    def close(self):
+        try:
+            self._view.release()
+            if self._mm:
+                self._mm.close()
+        except BufferError:
+            # payload views are still held by packets in flight
+            pass
+        self._f.close()
+
+class Stream_chunker():
+    """
+    Chunker over a stream of blocks that are only produced when asked for,
+    the compressor's frames. A block is pulled once a packet needs its
+    bytes, so the stream is built as the window opens rather than ahead of
+    the first packet, and total stays TOTAL_UNKNOWN until it runs out.
+    Blocks are dropped once every chunk in them is acked, less the last
+    `keep` chunks that parity packets may still be built from.
+    """
+    def __init__(self, blocks, chunk_sz:int, keep:int=0):
+        self.chunk_sz = chunk_sz
+        self.size     = 0           # stream bytes pulled so far
+        self.total    = TOTAL_UNKNOWN
+        self.next_id  = 0
+        self.keep     = keep
+        self._blocks  = blocks
+        self._held    = collections.deque()     # (stream offset, block)
+        self._acked   = set()
+        self._floor   = 0
+    def _pull(self, end:int):
+        """ pulls blocks until the stream reaches `end` bytes or runs out """
+        while self.size < end and self.total == TOTAL_UNKNOWN:
+            block = next(self._blocks, None)
+            if block is None:
+                self.total = math.ceil(self.size / self.chunk_sz)
+                break
+            self._held.append((self.size, block))
+            self.size += len(block)
+    def __len__(self):
+        self._pull(self.next_id * self.chunk_sz + 1)
+        if self.total == TOTAL_UNKNOWN:
+            return math.ceil(self.size / self.chunk_sz) - self.next_id
+        return self.total - self.next_id
+    def get(self, n:int):
+        start = n * self.chunk_sz
+        end   = min(start + self.chunk_sz, self.size)
+        parts = []
+        for offset, block in self._held:
+            if offset >= end:
+                break
+            if offset + len(block) > start:
+                parts.append(memoryview(block)[max(start - offset, 0) : end - offset])
+        return parts[0] if len(parts) == 1 else b''.join(parts)
+    def next(self):
+        # a byte past the chunk tells whether it is the last one, so its
+        # packet goes out with the total
+        self._pull((self.next_id + 1) * self.chunk_sz + 1)
+        if self.next_id * self.chunk_sz >= self.size:
+            return None
+        n = self.next_id
+        self.next_id += 1
+        return n, self.get(n)
+    def release(self, n:int):
+        self._acked.add(n)
+        floor = self._floor
+        while floor in self._acked:
+            self._acked.remove(floor)
+            floor += 1
+        self._floor = floor
+        end = (floor - self.keep) * self.chunk_sz
+        while self._held and self._held[0][0] + len(self._held[0][1]) <= end:
+            self._held.popleft()
+    def close(self):
+        self._held.clear()
+        self._blocks.close()
 
 class Sender(Monitor):
+    RATE_ROUNDS = 10
+    # expected parity packets per block below which a block gets none
+    MIN_PARITY  = 0.5
+
     def __init__(self, cfg_path):
         super().__init__(cfg_path, 'sender')
         cfg = configparser.RawConfigParser(allow_no_value=True)
         cfg.read(cfg_path)
         self.recv_id       = int(cfg.get('receiver', 'id'))
-        self.packet_queue  = []
-
-        BaseManager.register('Ack_buff', Ack_buff)
-        BaseManager.register('Packet', Packet)
-        self.manager = BaseManager()
-        self.manager.start()
-        self.ack_queue     = Queue()
-        self.buffer        = self.manager.Ack_buff()
+        self.header_fmt    = cfg.get('sender', 'header_format', fallback=FMT_BINARY)
+        self.send_sacks    = (int(cfg.get('receiver', 'send_sacks', fallback='0')) == 1
+                              or int(cfg.get('receiver', 'ack_every', fallback='1')) > 1)
+        self.dup_thresh    = 3
+        self.fin_retries   = FIN_RETRIES
+        self.fin_acked     = False
+        self.wire_overhead = len(format_packet(self.id, self.recv_id, b''))
+        self.chunker       = None
+        self.buffer        = Send_window()
+        self.timers        = Retx_timers()
+        self.last_progress = 0.0     # when the oldest unacked packet was last acked
+        self.n_acked       = 0
+        self.fast_resent   = set()
+        self.n_fast_retx   = 0
+        self.n_timeout_retx = 0
+        self.n_acks        = 0
+        self._batch        = None
 
         self.ppbw          = (self.Config.MAX_PACKET_SIZE / self.Config.LINK_BANDWIDTH)
         self.rtt           = (self.ppbw + 2 * float(cfg.get('network', 'PROP_DELAY')))
-        self.timeout       = 4 * self.rtt
-        self.cong_thresh   = int(self.rtt / self.ppbw)
-        self.cong_thresh_max = self.cong_thresh * 1.25
-        self.window_sz     = self.cong_thresh
-        self.is_buff_only  = False
+        self.rtt_log       = cfg.get('sender', 'rtt_log', fallback=None)
+        self.rtt_est       = Rtt_estimator(4 * self.rtt,
+                                           float(cfg.get('sender', 'min_rto',    fallback='1.0')),
+                                           float(cfg.get('sender', 'rto_margin', fallback='0.05')),
+                                           history=self.rtt_log is not None)
+        self.n_spurious_retx = 0
+        self.cc            = make_controller(cfg.get('sender', 'congestion_control', fallback='legacy'),
+                                             self.Config.MAX_PACKET_SIZE, self.rtt, self.ppbw)
+
+        # pacing is off, fixed at the link bandwidth, or follows the delivery rate
+        self.pacing        = cfg.get('sender', 'pacing', fallback='off')
+        self.pacer         = None
+        if self.pacing != 'off':
+            self.pacer     = Pacer(self.Config.LINK_BANDWIDTH, 4 * self.Config.MAX_PACKET_SIZE)
+        self.acked_bytes   = 0
+        # delivery rate samples of the last RATE_ROUNDS rounds, the pacer
+        # follows their max. A round ends once everything in flight at its
+        # start is acked
+        self.delivery_rates = collections.deque(maxlen=self.RATE_ROUNDS)
+        self.round_end     = None
+        self.round_start   = None
+        self.pacer_limited = False
+
+        # forward error correction, m parity packets per block of fec_k
+        # with m/fec_k following the measured loss rate
+        self.fec           = int(cfg.get('sender', 'fec', fallback='0')) == 1
+        self.fec_k         = int(cfg.get('sender', 'fec_k', fallback='16'))
+        self.fec_m_max     = int(cfg.get('sender', 'fec_m_max', fallback='4'))
+        self.loss_rate     = 0.0
+        self.n_fec_acked   = 0      # packets the receiver rebuilt from parity
+        self.n_lost_seen   = 0
+        self.n_parity      = 0
+        self.block_parity  = {}     # block start -> parity packets sent for it
+        if self.fec:
+            if self.header_fmt != FMT_BINARY:
+                raise ValueError('fec needs header_format=binary to flag parity packets')
+            # numpy is only needed with fec on
+            import fec
+            self.fec_codec = fec
+            if not 0 <= self.fec_m_max <= fec.M_MAX:
+                raise ValueError(f'fec_m_max must be between 0 and {fec.M_MAX}, got {self.fec_m_max}')
+
+        # block compression of the file, zlib, lzma or auto picks per transfer
+        self.compression   = cfg.get('sender', 'compression', fallback='off')
+        self.compressor    = None
+        if self.compression != 'off':
+            self.compressor = Compressor(self.compression, self.Config.LINK_BANDWIDTH,
+                                         int(cfg.get('sender', 'compress_block', fallback='65536')))
+
+        # cwnd, rtt, in flight and retransmits sampled over time to a CSV
+        self.metrics       = None
+        if cfg.get('sender', 'metrics_log', fallback=None):
+            self.ack_rate  = Rate()
+            self.metrics   = Metrics_log(cfg.get('sender', 'metrics_log'), self.probe,
+                                         float(cfg.get('sender', 'metrics_interval', fallback='0.1')))
         # self.socketfd.settimeout(self.timeout)
     def __str__(self, blocking=True):
         msg = f'Sender:\n  '
         msg += '\n  '.join([f'{k} == {v}' for (k,v) in self.__dict__.items()])
         return msg
+    def transmit(self, pkt):
+        data = pkt.format()
+        if self._batch is not None:
+            self._batch.append(data)
+        else:
+            super().send(self.recv_id, data)
+        if self.pacer:
+            self.pacer.consume(len(data) + self.wire_overhead)
+    def batch_start(self):
+        """ holds back transmissions until batch_flush sends them with one send_many """
+        self._batch = []
+    def batch_flush(self):
+        batch, self._batch = self._batch, None
+        if batch:
+            self.send_many(self.recv_id, batch)
     def send(self, pkt):
-        super().send(self.recv_id, pkt.format())
+        pkt.ts     = timestamp()
+        pkt.sends += 1
+        self.transmit(pkt)
         pkt.reset_age()
-    def update_rtt(self, rtt:int):
-        a = 0.875
-        rtt     *= 1.65
-        self.rtt     = self.rtt * a + rtt * (1-a)
-        self.timeout = self.timeout * a + self.rtt * (1-a)
-
-    def update_window(self, is_congested=False):
-        if is_congested:
-            self.cong_thresh = max(min(self.cong_thresh, self.cong_thresh_max, self.window_sz) // 2, 1)
-            self.window_sz   = self.cong_thresh
-        else:
-            self.cong_thresh = int(min(self.rtt / 1.5 / self.ppbw, self.cong_thresh_max))
-            old = self.window_sz
-            if self.window_sz >= self.cong_thresh:
-                self.window_sz += 1
-            else:
-                new = self.window_sz * 2
-                if new > self.cong_thresh:
-                    self.window_sz = self.cong_thresh
-                else:
-                    self.window_sz = new
+        self.timers.arm(pkt.get_id(), time.time() + self.rtt_est.rto)
+    def rtt_sample(self, pkt:Packet, ts_echo:int) -> float:
+        # an echoed timestamp says exactly which transmission was acked,
+        # without one fall back to Karn's rule and skip retransmitted packets
+        if ts_echo:
+            return timestamp_age(ts_echo)
+        if pkt.sends == 1:
+            return pkt.get_age()
+        return None
 
     def get_packets(self):
-        # TODO: when a file is VERY large, will run out of
-        #       memory with this method
-        packet_num_byt = (str((sys.maxsize,sys.maxsize)) + '|').encode()
-        packet_header  = format_packet(self.id, self.recv_id, b'')
-        packet_data_sz = self.Config.MAX_PACKET_SIZE - (len(packet_header) + len(packet_num_byt))
-        total_packets  = math.ceil(os.path.getsize(self.file) / packet_data_sz)
-        with open(self.file, 'rb') as f:
-            for i in range(total_packets):
-                self.packet_queue.append(
-                    self.manager.Packet(((i,total_packets), f.read(packet_data_sz)), is_bytes=False)
-                )
-        return total_packets
-
-    def scan_acks(self):
-        while True:
-            ack_sender, ack_data = self.recv(self.Config.MAX_PACKET_SIZE)
-            if (ack_sender == self.recv_id):
-                ack_num = int(ack_data.decode())
-                self.ack_queue.put(ack_num)
-
-    def handle_acks(self, kill:threading.Event, total_packets:int):
-        ack_scanner   = Process(target=self.scan_acks)
-        ack_scanner.start()
-
-        acked       = set(list(range(total_packets)))
-        fast_resent = set()
-        last_ping   = time.time()
-
-        def _send_zipup():
-            for pkt_id in acked:
-                pkt = self.buffer.get(id=pkt_id)
-                if pkt and (pkt.get_age() > self.rtt / 2):
-                    print(f'resend {pkt_id}')
-                    self.send(pkt)
-
-        while (not kill.is_set()) and (len(acked) > 0):
-            # for every timeout seconds, update the window size
-            if (time.time() - last_ping > self.rtt):
-                self.update_window()
-                last_ping = time.time()
+        packet_data_sz = self.Config.MAX_PACKET_SIZE - (self.wire_overhead + header_size(self.header_fmt))
+        if self.fec:
+            # parity payloads carry a length prefix on top of the data
+            packet_data_sz -= self.fec_codec.LENGTH.size
+        if self.compressor:
+            # start the goodput clock before compressing, the time spent on it
+            # has to be paid for by the bytes it saves on the wire. Blocks are
+            # compressed as the window takes their packets, parity packets
+            # may still need the last fec block after it is acked
+            self.last_sent_time = time.time()
+            self.chunker = Stream_chunker(self.compressor.frames(self.file), packet_data_sz,
+                                          self.fec_k if self.fec else 0)
+        else:
+            self.chunker = Chunker(self.file, packet_data_sz)
+
+    def next_packet(self):
+        n, data = self.chunker.next()
+        pkt     = Packet(((n,self.chunker.total), data), is_bytes=False, fmt=self.header_fmt)
+        if n + 1 == self.chunker.total:
+            pkt.flags |= FLAG_LAST
+        return pkt
 
-            # remove acks and update the RTT and timeout according to the 
-            # time it took to ack the given packet
+    def recv_acks(self):
+        """ drains every ack waiting on the socket without blocking """
+        while True:
             try:
-                ack_num = self.ack_queue.get_nowait() # errors when queue is empty
-
-                # remove the packet from buffer
-                if ack_num in acked:
-                    pkt = self.buffer.remove(ack_num)
-                    if pkt:
-                        acked.remove(ack_num)
-                        self.update_rtt(pkt.get_age())
-
-                # check current ack num compared to lowest packet in buffer
-                # retransmit if needed
-                pkt = self.buffer.get()
-                if pkt and (ack_num - pkt.get_id() > 2) and (pkt.get_id() not in fast_resent):
-                    print(f'fast retransmit: {pkt.get_id()}')
-                    fast_resent.add(pkt.get_id())
-                    self.send(pkt)
-                    self.buffer.cycle()
-
-            except:
-                pass
-            
-            # check for timeouts
-            if self.ack_queue.empty():
-                pkt = self.buffer.get()
-                if pkt and (pkt.get_age() > self.timeout):
-                    # self.update_window(is_congested=True)
-                    # self.timeout = self.timeout * 1.5
-                    print(f'timeout: {pkt} age  {pkt.get_age()}')
-                    self.send(pkt)
-                    self.buffer.cycle()
-            # else:
-            #     print(f'size of ackbuff {self.ack_queue.qsize()}')
-
-
-            # zip up unsent packets when no more packets can be added to buff
-            # if self.is_buff_only:
-            #     self.is_buff_only = False
-            #     _send_zipup()
-
-        ack_scanner.terminate()
-        ack_scanner.join()
+                acks = self.recv_many(64)
+            except BlockingIOError:
+                return
+            for ack_sender, ack_data in acks:
+                if (ack_sender != self.recv_id):
+                    continue
+                self.n_acks += 1
+                if self.send_sacks:
+                    self.handle_sack(*unformat_sack(ack_data))
+                else:
+                    self.handle_ack(*unformat_ack(ack_data))
+
+    def acknowledge(self, n:int, ack_num:int, ts_echo:int):
+        # remove the packet from buffer and update the RTT and timeout
+        # according to the time it took to ack the given packet. Packets
+        # acked cumulatively or by sack blocks give no rtt sample.
+        oldest = self.buffer.oldest()
+        pkt    = self.buffer.remove(n)
+        if pkt:
+            if pkt is oldest:
+                self.last_progress = time.time()
+            self.timers.cancel(n)
+            self.n_acked += 1
+            # the receiver acks a packet it rebuilt from parity with no
+            # timestamp to echo, that is a loss fec repaired
+            if self.fec and n == ack_num and not ts_echo:
+                self.n_fec_acked += 1
+            self.acked_bytes += len(pkt.data)
+            self.chunker.release(n)
+            rtt = None
+            if n == ack_num:
+                rtt = self.rtt_sample(pkt, ts_echo)
+                if rtt is not None:
+                    self.rtt_est.update(rtt)
+                # the ack was for an earlier transmission than the last one
+                if ts_echo and pkt.sends > 1 and ts_echo != pkt.ts:
+                    self.n_spurious_retx += 1
+            self.cc.on_ack(n, rtt)
+
+    def fast_retransmit(self, pkt:Packet):
+        print(f'fast retransmit: {pkt.get_id()}')
+        self.fast_resent.add(pkt.get_id())
+        self.n_fast_retx += 1
+        self.cc.on_loss(pkt.get_id(), self.chunker.next_id - 1, self.buffer.size())
+        self.send(pkt)
+
+    def handle_ack(self, ack_num:int, ts_echo:int):
+        if ack_num == self.chunker.total:
+            self.fin_acked = True
+            return
+        self.acknowledge(ack_num, ack_num, ts_echo)
+
+        # check current ack num compared to lowest packet in buffer
+        # retransmit if needed
+        pkt = self.buffer.oldest()
+        if (pkt and (ack_num - pkt.get_id() > 2) and (pkt.get_id() not in self.fast_resent)
+                and not self.parity_pending(pkt.get_id(), ack_num)):
+            self.fast_retransmit(pkt)
+
+    def parity_pending(self, n:int, highest:int) -> bool:
+        """
+        Whether the parity of hole n's block may still repair it, given the
+        highest seq num acked. It has had time to arrive once a packet past
+        the block, sent after it, is acked. Holding the retransmit until
+        then keeps fec and retransmission from repairing the same loss.
+        Nothing follows the last block, its holes are not held.
+        """
+        if not self.fec:
+            return False
+        start = n - n % self.fec_k
+        end   = start + self.fec_k
+        if end >= self.chunker.total or highest >= end:
+            return False
+        return self.block_parity.get(start, self.fec_m()) > 0
+
+    def handle_sack(self, cum:int, ack_num:int, ts_echo:int, sacked:list):
+        if ack_num == self.chunker.total:
+            self.fin_acked = True
+            return
+        pkt = self.buffer.oldest()
+        while pkt and pkt.get_id() < cum:
+            self.acknowledge(pkt.get_id(), ack_num, ts_echo)
+            pkt = self.buffer.oldest()
+        for n in sacked:
+            self.acknowledge(n, ack_num, ts_echo)
+
+        # a hole is lost once dup_thresh packets above it have been sacked and
+        # parity can no longer repair it, retransmit exactly those holes
+        if not sacked:
+            return
+        highest = max(sacked)
+        sacked  = set(sacked)
+        above   = 0
+        for n in range(highest, cum - 1, -1):
+            if n in sacked:
+                above += 1
+            elif above >= self.dup_thresh and n not in self.fast_resent and not self.parity_pending(n, highest):
+                pkt = self.buffer.get(id=n)
+                if pkt:
+                    self.fast_retransmit(pkt)
+
+    def check_timeouts(self):
+        # acks that move the oldest unacked packet restart the timer (RFC 6298
+        # 5.3), packets queued behind it get an rto from that ack instead of
+        # from when they were sent
+        now     = time.time()
+        restart = self.last_progress + self.rtt_est.rto
+        expired = []
+        for n in self.timers.expired(now):
+            pkt = self.buffer.get(n)
+            if pkt is None:
+                continue
+            if restart > now:
+                self.timers.arm(n, restart)
+            else:
+                expired.append(pkt)
+        if not expired:
+            return
+        # timers that fire together are one timeout event, back off once
+        self.rtt_est.backoff()
+        self.batch_start()
+        for pkt in expired:
+            print(f'timeout: {pkt} age  {pkt.get_age()}')
+            self.n_timeout_retx += 1
+            self.cc.on_timeout(pkt.get_id(), self.chunker.next_id - 1, self.buffer.size())
+            self.send(pkt)
+        self.batch_flush()
+
+    def update_pacing(self):
+        # pace a little above the best delivery rate of the last few rounds
+        # so the rate can still grow, never above the link bandwidth. Only
+        # whole rounds count, one cut short reads low because the acks for
+        # the end of its flight are not in yet. So do only rounds the pacer
+        # held back, in the others the window set the rate, not the path
+        if self.pacing == 'measured':
+            now    = time.time()
+            oldest = self.buffer.oldest()
+            if self.round_end is not None and (oldest is None or oldest.id >= self.round_end):
+                if self.pacer_limited and self.acked_bytes > 0 and now > self.round_start:
+                    self.delivery_rates.append(self.acked_bytes / (now - self.round_start))
+                    self.pacer.rate = min(1.25 * max(self.delivery_rates), self.Config.LINK_BANDWIDTH)
+                self.round_end = None
+            if self.round_end is None:
+                self.round_end     = self.chunker.next_id
+                self.round_start   = now
+                self.acked_bytes   = 0
+                self.pacer_limited = False
+        elif self.pacing == 'cc':
+            self.pacer.rate = min(self.cc.pacing_rate(), self.Config.LINK_BANDWIDTH)
+
+    def can_send(self) -> bool:
+        return len(self.chunker) > 0 and self.buffer.size() < self.cc.window()
+
+    def fec_m(self) -> int:
+        # twice the expected losses per block, so the overhead stays
+        # bounded by the loss rate. The estimate only decays towards 0, so
+        # below MIN_PARITY it drops to nothing for a clean link
+        expected = 2 * self.loss_rate * self.fec_k
+        if expected < self.MIN_PARITY:
+            return 0
+        return min(self.fec_m_max, math.ceil(expected))
+
+    def send_parity(self, n:int):
+        """ sends the parity packets of the block that seq num n closes """
+        start = n - n % self.fec_k
+        # losses are the retransmits plus what parity repaired, counting only
+        # the retransmits would have fec lower its own rate the better it works
+        n_lost = self.n_fast_retx + self.n_timeout_retx + self.n_fec_acked
+        self.loss_rate   = 0.9 * self.loss_rate + 0.1 * min((n_lost - self.n_lost_seen) / (n + 1 - start), 1)
+        self.n_lost_seen = n_lost
+
+        m = min(self.fec_m(), n + 1 - start)
+        self.block_parity[start] = m
+        # blocks wholly below the oldest unacked packet need no hold back
+        oldest = self.buffer.oldest()
+        floor  = oldest.id if oldest else n + 1
+        for done in [b for b in self.block_parity if b + self.fec_k <= floor]:
+            del self.block_parity[done]
+        if m == 0:
+            return
+        payloads = [self.chunker.get(i) for i in range(start, n + 1)]
+        for j, parity in enumerate(self.fec_codec.encode(payloads, m)):
+            pkt = Packet(((start, self.chunker.total), parity), fmt=self.header_fmt)
+            pkt.flags = self.fec_codec.parity_flags(m, j)
+            self.transmit(pkt)
+            self.n_parity += 1
+
+    def fill_window(self):
+        self.batch_start()
+        while self.can_send():
+            if self.pacer and not self.pacer.ready(self.Config.MAX_PACKET_SIZE):
+                self.pacer_limited = True
+                break
+            pkt = self.next_packet()
+            self.send(pkt)
+            self.buffer.push(pkt)
+            if self.fec and ((pkt.id + 1) % self.fec_k == 0 or pkt.id + 1 == pkt.total):
+                self.send_parity(pkt.id)
+        self.batch_flush()
+
+    def probe(self) -> dict:
+        return {
+            'cwnd':         self.cc.cwnd,
+            'ssthresh':     self.cc.ssthresh,
+            'srtt':         self.rtt_est.srtt,
+            'rto':          self.rtt_est.rto,
+            'in_flight':    self.buffer.size(),
+            'sent':         self.chunker.next_id if self.chunker else 0,
+            'acked':        self.n_acked,
+            'fast_retx':    self.n_fast_retx,
+            'timeout_retx': self.n_timeout_retx,
+            'ack_rate':     self.ack_rate(self.n_acks),
+        }
+
+    def close(self, sel) -> bool:
+        """
+        Sends a FIN, an empty packet with seq num == total, until the receiver
+        acks it or fin_retries run out. Every data packet is acked by now, so
+        there is nothing to back off for, the FIN goes out every FIN_INTERVAL
+        rtts and a lost FIN ack costs a few rtts rather than a row of rtos.
+        """
+        total    = self.chunker.total
+        fin      = Packet(((total, total), b''), fmt=self.header_fmt)
+        interval = FIN_INTERVAL * (self.rtt_est.min_rtt or self.rtt)
+        for _ in range(self.fin_retries):
+            fin.ts   = timestamp()
+            self.transmit(fin)
+            deadline = time.time() + interval
+            while not self.fin_acked and time.time() < deadline:
+                if sel.select(max(deadline - time.time(), 0)):
+                    self.recv_acks()
+            if self.fin_acked:
+                return True
+        return False
 
     def run(self):
-        total_packets = self.get_packets()
-
-        ack_killer    = threading.Event()
-        ack_handler   = threading.Thread(target=self.handle_acks, args=(ack_killer,total_packets))
-        ack_handler.start()
-
-        while len(self.packet_queue) > 0:
-            if self.buffer.size() < self.window_sz:
-                pkt = self.packet_queue.pop(0)
-                self.send(pkt)
-                self.buffer.push(pkt)
-                # print(f'{pkt} -> buff_sz[{self.buffer.size()}]')
-        self.is_buff_only = True
-
-        # wait for the buffer to clear
-        print('waiting for the buffer to clear')
-        while self.buffer.size() > 0:
-            pass
-        ack_killer.set()
-        self.send_end(self.recv_id)
+        cpu_start     = time.process_time()
+        self.get_packets()
+        if self.metrics:
+            self.metrics.start()
+
+        self.socketfd.setblocking(False)
+        sel = selectors.DefaultSelector()
+        sel.register(self.socketfd, selectors.EVENT_READ)
+
+        # sleep until an ack arrives (which is also the only thing that opens
+        # the window), the pacer has tokens for the next packet, the next
+        # window update is due, or the earliest retransmission deadline fires
+        last_ping = time.time()
+        # the total of a compressed stream is TOTAL_UNKNOWN until it is all cut
+        while self.n_acked < self.chunker.total:
+            self.fill_window()
+
+            # for every rtt seconds, let the congestion control update the window
+            self.rtt = self.rtt_est.srtt or self.rtt
+            if (time.time() - last_ping > self.rtt):
+                self.cc.on_round(self.rtt)
+                if self.pacer:
+                    self.update_pacing()
+                last_ping = time.time()
 
+            wait     = self.rtt - (time.time() - last_ping)
+            deadline = self.timers.next_deadline()
+            if deadline:
+                wait = min(wait, deadline - time.time())
+            if self.pacer and self.can_send():
+                wait = min(wait, self.pacer.wait_time(self.Config.MAX_PACKET_SIZE))
+            if sel.select(max(wait, 0)):
+                self.recv_acks()
+            self.check_timeouts()
+
+        cpu_time = time.process_time() - cpu_start
+        if self.metrics:
+            self.metrics.stop()
+        # compressed, the payload is the framed stream rather than the file
+        self.send_end(self.recv_id, terminate=False,
+                      payload_size=self.compressor.size if self.compressor else None)
+        log(self.LOG_FILE_PATH, f'CPU Time					: {round(cpu_time, 3)} secs')
+        log(self.LOG_FILE_PATH, f'CPU Time per MB			: {round(cpu_time / max(os.path.getsize(self.file) / 1e6, 1e-6), 3)} secs')
+        log(self.LOG_FILE_PATH, f'Fast Retransmits			: {self.n_fast_retx}')
+        log(self.LOG_FILE_PATH, f'Timeout Retransmits		: {self.n_timeout_retx}')
+        log(self.LOG_FILE_PATH, f'Spurious Retransmits		: {self.n_spurious_retx}')
+        if self.fec:
+            log(self.LOG_FILE_PATH, f'Parity Packets				: {self.n_parity}')
+        if self.compressor:
+            log(self.LOG_FILE_PATH, f'Compression				: {self.compressor.method}, {self.compressor.n_compressed}/{self.compressor.n_blocks} blocks')
+            log(self.LOG_FILE_PATH, f'Compression Time			: {round(self.compressor.time, 3)} secs')
+        if self.rtt_log:
+            self.rtt_est.export(self.rtt_log)
+
+        fin_acked = self.close(sel)
+        sel.close()
+        self.chunker.close()
+        self.terminate_emulator()
+        log(self.LOG_FILE_PATH, f'FIN Acked					: {fin_acked}')
+        log(self.LOG_FILE_PATH, f'Process Lifetime			: {round(time.time() - START_TIME, 3)} secs')
 
 def main():
     parser = argparse.ArgumentParser(
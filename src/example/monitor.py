@@ -2,6 +2,10 @@ import socket
 import time
 import sys
 import os
+import hashlib
+import atexit
+import queue
+import threading
 from typing import Tuple, List
 
 # Config File
@@ -36,7 +40,10 @@ def unformat_packet(packet: bytes or tuple) -> Tuple[int, bytes]:
 
 	# Attempt to split
 	try:
-		return int(packet.split(b'\n')[0].split(b' ')[0]), packet.split(b'\n', maxsplit=1)[1]
+		head, sep, content = packet.partition(b'\n')
+		if not sep:
+			raise ValueError('Packet has no header line')
+		return int(head.split(b' ', 1)[0]), content
 	except:
 		# Failed to parse packet!
 		import traceback
@@ -45,10 +52,93 @@ def unformat_packet(packet: bytes or tuple) -> Tuple[int, bytes]:
 		return None, None
 
 
+def unformat_buffer(buf: bytearray, n: int) -> Tuple[int, memoryview]:
+	""" Same as unformat_packet for the first n bytes of buf, but the content is a memoryview into buf so nothing is copied """
+	try:
+		end = buf.find(b'\n', 0, n)
+		if end < 0:
+			raise ValueError('Packet has no header line')
+		space = buf.find(b' ', 0, end)
+		return int(buf[:space if space >= 0 else end]), memoryview(buf)[end + 1:n]
+	except:
+		# Failed to parse packet!
+		import traceback
+		traceback.print_exc()
+		print(f'Invalid packet received:\n{bytes(buf[:n]).decode("ascii", "replace")}')
+		return None, None
+
+
+def file_digest(path, chunk_size=1 << 20) -> bytes:
+	""" BLAKE2b digest of a file, read chunk by chunk so memory stays constant whatever its size """
+	digest = hashlib.blake2b()
+	with open(path, 'rb') as f:
+		for chunk in iter(lambda: f.read(chunk_size), b''):
+			digest.update(chunk)
+	return digest.digest()
+
+
+class LogSink:
+	"""
+	Appends log lines from a background thread instead of opening the log file on every call.
+	Lines wait in a bounded queue and are written in batches, one open per file per batch, at
+	least every FLUSH_INTERVAL seconds, on flush() and when the process exits. write() only
+	blocks when MAX_PENDING lines are already waiting.
+	"""
+	FLUSH_INTERVAL = 0.5
+	MAX_PENDING = 10000
+	_FLUSH = 'flush'
+
+	def __init__(self):
+		self._queue = queue.Queue(maxsize=self.MAX_PENDING)
+		self._thread = threading.Thread(target=self._run, daemon=True)
+		self._thread.start()
+		atexit.register(self.close)
+
+	def write(self, path, text):
+		self._queue.put((path, text))
+
+	def flush(self):
+		""" Blocks until every line written so far is in its file """
+		self._queue.put(self._FLUSH)
+		self._queue.join()
+
+	def close(self):
+		if self._thread.is_alive():
+			self._queue.put(None)
+			self._thread.join()
+
+	def _run(self):
+		running = True
+		while running:
+			# Wait for a line, then gather whatever else comes in until the flush deadline
+			items = [self._queue.get()]
+			deadline = time.time() + self.FLUSH_INTERVAL
+			while isinstance(items[-1], tuple):
+				try:
+					items.append(self._queue.get(timeout=max(deadline - time.time(), 0)))
+				except queue.Empty:
+					break
+			running = items[-1] is not None
+
+			files = {}
+			for item in items:
+				if isinstance(item, tuple):
+					files.setdefault(item[0], []).append(item[1])
+			for path, lines in files.items():
+				with open(path, 'a+') as f:
+					f.writelines(lines)
+			for _ in items:
+				self._queue.task_done()
+
+
+_log_sink = None
+
 def log(LOG_FILE_PATH, message):
-	""" Logs a message for the user """
-	with open(LOG_FILE_PATH, 'a+') as f:
-		f.write(f'{message}\n')
+	""" Logs a message for the user, the line reaches the file through the LogSink """
+	global _log_sink
+	if _log_sink is None:
+		_log_sink = LogSink()
+	_log_sink.write(LOG_FILE_PATH, f'{message}\n')
 
 def receiver_id(LOG_FILE_PATH, message):
 		"""
@@ -75,6 +165,23 @@ def sender_id(LOG_FILE_PATH, message):
 		print('Error reading sender ID from first line of packet.')
 		return None
 
+class BufferPool:
+	"""
+	Free list of receive buffers for recv_many. get() only allocates a new buffer when all of them
+	are in use, put() takes back a buffer, or a memoryview into one, once its content has been consumed.
+	"""
+	def __init__(self, size, n=0):
+		self.size = size
+		self._free = [bytearray(size) for _ in range(n)]
+
+	def get(self):
+		return self._free.pop() if self._free else bytearray(self.size)
+
+	def put(self, buf):
+		if isinstance(buf, memoryview):
+			buf = buf.obj
+		self._free.append(buf)
+
 # ==========================================================================================================================================
 # Network Monitor Class
 # ==========================================================================================================================================
@@ -108,6 +215,9 @@ class Monitor:
 		self.out_data = {self.addr[1]: 0}
 		self.out_packets = {self.addr[1]: 0}
 
+		# Formatted header line per destination, reused by send_many
+		self._headers = {}
+
 	def read_config_file(self, path, heading):
 		""" Reads the configuration file and sets parameters """
 		global NePORT
@@ -163,6 +273,88 @@ class Monitor:
 		#print(f'Sending seq num {snum}')
 		self.socketfd.sendto(format_packet(self.id, dest, data), self.ne_addr)
 
+	def send_many(self, dest, payloads):
+		"""
+		Sends every payload in the list to the specified address, in order. The statistics
+		are updated once for the whole batch and end up exactly as if send() was called per payload.
+		"""
+		if not isinstance(dest, int):
+			raise ValueError("Destination must be an integer")
+		if not all(isinstance(data, bytes) for data in payloads):
+			raise ValueError("Data must be a byte string")
+		if not payloads:
+			return
+
+		# The per packet time deltas add up to the time since the last send
+		now = time.time()
+		if self.last_sent_time:
+			self.total_time += now - self.last_sent_time
+		self.last_sent_time = now
+
+		self.out_data[dest] = self.out_data.get(dest, 0) + sum(len(data) for data in payloads)
+		self.out_packets[dest] = self.out_packets.get(dest, 0) + len(payloads)
+
+		# Gather the header line and payload into one datagram without concatenating them
+		header = self._headers.get(dest)
+		if header is None:
+			header = self._headers[dest] = format_packet(self.id, dest, b'')
+		sendmsg = self.socketfd.sendmsg
+		for data in payloads:
+			sendmsg((header, data), (), 0, self.ne_addr)
+
+	def recv_many(self, max_n, size=None, pool=None):
+		"""
+		Returns a list of up to max_n Tuple(sender ID, data) received at the socket. The first
+		receive follows the socket's blocking mode and timeout like recv(), the rest only drain
+		what is already queued. The statistics are updated once for the whole batch.
+		With a BufferPool the datagrams are read into its buffers with recvfrom_into and data is a
+		memoryview into the buffer, which the caller has to put() back once it is done with it.
+		"""
+		size = (size or self.Config.MAX_PACKET_SIZE) + MAX_HEADER_OVERHEAD
+		if pool is None:
+			recvfrom = self.socketfd.recvfrom
+			def receive(flags=0):
+				return unformat_packet(recvfrom(size, flags))
+		else:
+			recvfrom_into = self.socketfd.recvfrom_into
+			def receive(flags=0):
+				buf = pool.get()
+				try:
+					n = recvfrom_into(buf, min(size, len(buf)), flags)[0]
+				except:
+					pool.put(buf)
+					raise
+				sender, data = unformat_buffer(buf, n)
+				if sender is None:
+					pool.put(buf)
+				return sender, data
+		received = [receive()]
+
+		# A socket with a timeout waits for it even with MSG_DONTWAIT, drain without one
+		timeout = self.socketfd.gettimeout()
+		if timeout:
+			self.socketfd.setblocking(False)
+		try:
+			while len(received) < max_n:
+				received.append(receive(socket.MSG_DONTWAIT))
+		except BlockingIOError:
+			pass
+		finally:
+			if timeout:
+				self.socketfd.settimeout(timeout)
+
+		batch = [(sender, data) for sender, data in received if sender is not None]
+
+		in_data = {}
+		in_packets = {}
+		for sender, data in batch:
+			in_data[sender] = in_data.get(sender, 0) + len(data)
+			in_packets[sender] = in_packets.get(sender, 0) + 1
+		for sender in in_data:
+			self.in_data[sender] = self.in_data.get(sender, 0) + in_data[sender]
+			self.in_packets[sender] = self.in_packets.get(sender, 0) + in_packets[sender]
+		return batch
+
 	def recv(self, size):
 		"""
 		Returns the Tuple(sender ID, data) received at the socket.
@@ -185,19 +377,27 @@ class Monitor:
 			
 		return sender, data
 
-	def send_end(self, dest_id):
+	def send_end(self, dest_id, terminate=True, payload_size=None):
 		"""Signals the end of transmission of the file. Should be called after the last ACK receive.
 
 		Args:
 			file : Path to the file being transmitted.
+			terminate : Stops the network emulator. Pass False to keep using it, e.g. to close the
+				connection, and call terminate_emulator() once done.
+			payload_size : Bytes of payload the file went out as, if not the file size (e.g. once
+				compressed). The overhead is counted on top of it.
 		"""
 		assert isinstance(dest_id, int), 'Please give an integer ID!'
 		self.total_time += time.time() - self.last_sent_time
 		filesize = os.path.getsize(self.file)
+		if payload_size is None:
+			payload_size = filesize
 		
 		log(self.LOG_FILE_PATH, f'File Size					: {filesize} bytes')
+		if payload_size != filesize:
+			log(self.LOG_FILE_PATH, f'Payload Size				: {payload_size} bytes')
 		log(self.LOG_FILE_PATH, f'Total Bytes Transmitted		: {self.out_data[dest_id]} bytes')
-		log(self.LOG_FILE_PATH, f'Overhead					: {self.out_data[dest_id] - filesize} bytes')
+		log(self.LOG_FILE_PATH, f'Overhead					: {self.out_data[dest_id] - payload_size} bytes')
 		log(self.LOG_FILE_PATH, f'Number of Packets sent		: {self.out_packets[dest_id]}')
 		log(self.LOG_FILE_PATH, f'Total Time					: {round(self.total_time, 2)} secs')
 		log(self.LOG_FILE_PATH, f'Goodput					: {round(filesize/self.total_time, 2)} bytes/sec')
@@ -207,30 +407,32 @@ class Monitor:
 		self.last_sent_time = None
 		self.last_recv_time = None
 		self.out_data[dest_id] = 0
+		if terminate:
+			self.terminate_emulator()
+
+	def terminate_emulator(self):
+		"""Tells the network emulator that the test is complete"""
 		self.socketfd.sendto(f'{0} {0}\n'.encode('ascii'), self.ne_addr)
 
-	def recv_end(self, recvfile, sender_id):
+	def recv_end(self, recvfile, sender_id, recv_digest=None, orig_digest=None):
 		"""Signals the end of receive of the file. Should be called after the last ACK is sent.
+		The files are compared by their BLAKE2b digests (see file_digest), which works for binary
+		files and takes constant memory.
 
 		Args:
 			file : Path to the file being transmitted.
+			recv_digest : Digest of the received file if it was already computed while it was written.
+			orig_digest : Digest of the original file if it was already computed during the transfer.
 		"""
 		match = True
 		if not os.path.exists(recvfile):
 			match = False
-		else:
-			with open(self.file) as orig:
-				with open(recvfile) as recv:
-					lines1 = orig.readlines()
-					lines2 = recv.readlines()
-					if len(lines1) != len(lines2):
-						log(self.LOG_FILE_PATH, f'Received file and original have differing number of lines.')
-						match = False
-					else:
-						for idx in range(len(lines1)):
-							if lines1[idx] != lines2[idx]:
-								log(self.LOG_FILE_PATH, f'Received file doesn\'t match the original file. Mismatch on line {idx}')
-								match = False
+		elif os.path.getsize(recvfile) != os.path.getsize(self.file):
+			log(self.LOG_FILE_PATH, f'Received file and original have differing sizes.')
+			match = False
+		elif (recv_digest or file_digest(recvfile)) != (orig_digest or file_digest(self.file)):
+			log(self.LOG_FILE_PATH, f'Received file doesn\'t match the original file.')
+			match = False
 
 		log(self.LOG_FILE_PATH, f'File transmission correct	: {match}')
 		log(self.LOG_FILE_PATH, f'Number of Packets Received	: {self.out_packets[sender_id]}')
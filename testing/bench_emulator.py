@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+
+import contextlib
+import os
+import socket
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '../emulator'))
+import emulator
+
+class List_latency_queue():
+    """ the latency stage the emulator used to have, a list scanned and popped from on every pass """
+    def __init__(self):
+        self._queue = []
+    def put(self, packet):
+        self._queue.append(packet)
+    def get_ready_packets(self):
+        ready = []
+        idx = 0
+        curtime = time.time()
+        while idx < len(self._queue):
+            if self._queue[idx].latency_complete_time < curtime:
+                ready.append(self._queue.pop(idx))
+            else:
+                idx += 1
+        return ready
+
+class List_sending_queue(emulator.SendingQueue):
+    """ the sending queue the emulator used to have, a list popped from the front and sliced on every add """
+    def __init__(self, socketfd, dest=None):
+        super().__init__(socketfd, dest)
+        self._queue = []
+    def get_next_packet(self):
+        if not self.check_for_available_bandwidth():
+            return
+        if not self._queue:
+            return None
+        next_packet = None
+        while self._queue and not next_packet:
+            next_packet = self._queue.pop(0)
+            if self.drop():
+                emulator.log(f'Dropped Packet from {next_packet.addr}')
+                print(f'Dropped Packet from {next_packet.addr}')
+                next_packet = None
+                continue
+            if len(self._queue) > 1 and self.reorder():
+                self._queue.insert(self._reorder_rng.randint(1, min(len(self._queue)-1, 6)), next_packet)
+                emulator.log(f'Reordered Packet from {next_packet.addr} to index {self._queue.index(next_packet)}')
+                print(f'Redordered Packet from {next_packet.addr} to index {self._queue.index(next_packet)}')
+                next_packet = None
+                continue
+        if next_packet is not None:
+            self._bandwidth_counter += len(next_packet.data)
+            self._queuesize -= len(next_packet.data)
+        return next_packet
+    def add(self, packets):
+        for packet in packets:
+            drop_count = max(0, len(self._queue) + 1 - emulator.Config.MAX_PACKETS_QUEUED)
+            self._queue = self._queue[:emulator.Config.MAX_PACKETS_QUEUED]
+            if drop_count > 0:
+                emulator.log(f'Dropped {drop_count} packet{"s" if drop_count > 1 else ""} for {packet.receiver_id()} due to full buffer.')
+                print(f'Dropped {drop_count} packet{"s" if drop_count > 1 else ""} for {packet.receiver_id()} due to full buffer.')
+            elif packet.receiver_id() != emulator.PACKET_FAIL:
+                self._queue.append(packet)
+                self._queuesize += len(packet.data)
+
+def run_sending(queue, queued:int, n:int):
+    """
+    Keeps the sending queue full at `queued` packets, offering a new packet after each get_next_packet,
+    and takes `n` packets off it with unlimited bandwidth. Returns (packets/sec, the payloads in the
+    order they left) so two queues seeded alike can be checked for identical output.
+    """
+    queue.check_for_available_bandwidth = lambda: True
+    packets = [emulator.Packet(b'1 2\n%d' % i, None) for i in range(queued + n)]
+    queue.add(packets[:queued])
+    out   = []
+    start = time.perf_counter()
+    for packet in packets[queued:]:
+        sent = queue.get_next_packet()
+        if sent is not None:
+            out.append(sent.data)
+        queue.add([packet])
+    return n / (time.perf_counter() - start), out
+
+def run(queue, in_flight:int, duration:float):
+    """
+    Keeps `in_flight` packets in the latency stage, putting a fresh packet back for every one that comes
+    out, for `duration` seconds, the way the emulator's main loop polls it. With PROP_DELAY set to
+    in_flight / OFFERED a stage that keeps up moves OFFERED pkts/sec with packets barely late.
+    Returns (packets/sec, passes/sec, mean ms a packet was late by).
+    """
+    data  = b'1 2\n' + bytes(1000)
+    start = time.time()
+    for i in range(in_flight):
+        packet = emulator.Packet(data, None)
+        packet.latency_complete_time = start + emulator.Config.PROP_DELAY * i / in_flight
+        queue.put(packet)
+
+    moved  = 0
+    passes = 0
+    late   = 0.0
+    while time.time() - start < duration:
+        ready = queue.get_ready_packets()
+        passes += 1
+        now   = time.time()
+        for packet in ready:
+            late += now - packet.latency_complete_time
+            queue.put(emulator.Packet(data, None))
+        moved += len(ready)
+    spent = time.time() - start
+    return moved / spent, passes / spent, late / max(moved, 1) * 1e3
+
+OFFERED = 100000
+
+def main():
+    emulator.Config = emulator.config()
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(('localhost', 0))     # the heap queue's receive thread just waits on it
+
+    for in_flight in (1000, 10000, 50000):
+        emulator.Config.PROP_DELAY = in_flight / OFFERED
+        for name, make_queue in (('list', List_latency_queue), ('heap', lambda: emulator.LatencyQueue(sock))):
+            pps, passes, late = run(make_queue(), in_flight, duration=3.0)
+            print(f'{in_flight:>6} in flight {name}: {round(pps):>7} pkts/sec, {round(passes):>7} passes/sec, '
+                  f'{round(late, 2):>7} ms late on average')
+
+    emulator.Config.DROP_MODEL = 1
+    emulator.Config.RANDOM_DROP_PROBABILITY = 0.01
+    emulator.Config.REORDER_PROBABILITY = 0.05
+    emulator.Config.SEED = 0
+    with tempfile.TemporaryDirectory() as tmp:
+        emulator.LOG_FILE_PATH = os.path.join(tmp, 'emulator.log')
+        for queued in (1000, 10000, 50000):
+            emulator.Config.MAX_PACKETS_QUEUED = queued + 1
+            outs = {}
+            for name, make_queue in (('list ', List_sending_queue), ('deque', emulator.SendingQueue)):
+                with contextlib.redirect_stdout(open(os.devnull, 'w')):
+                    pps, outs[name] = run_sending(make_queue(sock, 2), queued, n=20000)
+                print(f'{queued:>6} queued {name}: {round(pps):>7} pkts/sec')
+            assert outs['list '] == outs['deque'], 'sending queues diverged on the same seed'
+        if emulator._log_sink is not None:
+            emulator._log_sink.flush()
+    sock.close()
+
+if __name__ == '__main__':
+    main()
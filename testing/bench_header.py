@@ -0,0 +1,25 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '../src/designed_protocol'))
+from com import Packet, FMT_TEXT, FMT_BINARY, header_size
+
+def bench_format(fmt, n):
+    pkt   = Packet(((123456, 654321), bytes(1000)), fmt=fmt)
+    raw   = pkt.format()
+    t_fmt = timeit.timeit(pkt.format, number=n)
+    t_prs = timeit.timeit(lambda: Packet(raw, is_bytes=True, fmt=fmt), number=n)
+    return t_fmt / n, t_prs / n
+
+def main():
+    n = 200000
+    for fmt in (FMT_TEXT, FMT_BINARY):
+        t_fmt, t_prs = bench_format(fmt, n)
+        print(f'{fmt:>6}: header {header_size(fmt):>2} bytes, '
+              f'format {round(t_fmt*1e9)} ns/pkt, parse {round(t_prs*1e9)} ns/pkt')
+
+if __name__ == '__main__':
+    main()
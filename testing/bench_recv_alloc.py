@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+
+import os
+import socket
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '../src/designed_protocol'))
+from com     import Packet
+from monitor import Monitor, BufferPool, MAX_HEADER_OVERHEAD, format_packet
+
+CONFIG = """
+[emulator]
+port=9000
+[network]
+MAX_PACKET_SIZE=1024
+LINK_BANDWIDTH=200000
+[nodes]
+file_to_send={log}
+[receiver]
+id=2
+host=localhost
+port=9002
+log_file={log}
+"""
+
+def recv_copy(mon, batch):
+    """ the old path, recv() per datagram and the writer copying the payload out """
+    pkts = []
+    for _ in range(batch):
+        sender, data = mon.recv(mon.Config.MAX_PACKET_SIZE)
+        pkt = Packet(data, is_bytes=True)
+        pkts.append((pkt, bytearray(pkt.data)))
+    return pkts
+
+def recv_pooled(mon, batch, pool):
+    """ recvfrom_into pooled buffers, payload views handed on and the buffers returned after """
+    pkts = [Packet(data, is_bytes=True) for sender, data in mon.recv_many(batch, pool=pool)]
+    for pkt in pkts:
+        pool.put(pkt.data)
+    return pkts
+
+def run(mon, recv, n, batch):
+    """ returns (allocated bytes per packet, usec per packet) receiving n datagrams """
+    out   = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    dgram = format_packet(1, 2, Packet(((1, n), os.urandom(1000))).format())
+    alloc = 0
+    spent = 0
+    for _ in range(n // batch):
+        for _ in range(batch):
+            out.sendto(dgram, mon.addr)
+        tracemalloc.reset_peak()
+        start_mem = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        recv(mon, batch)
+        spent += time.perf_counter() - start
+        alloc += tracemalloc.get_traced_memory()[1] - start_mem
+    out.close()
+    return alloc / n, spent / n * 1e6
+
+def main():
+    n, batch = 20000, 32
+    with tempfile.TemporaryDirectory() as tmp:
+        cfg = os.path.join(tmp, 'bench.ini')
+        with open(cfg, 'w') as f:
+            f.write(CONFIG.format(log=os.path.join(tmp, 'bench.log')))
+        mon  = Monitor(cfg, 'receiver')
+        pool = BufferPool(mon.Config.MAX_PACKET_SIZE + MAX_HEADER_OVERHEAD, batch)
+
+        tracemalloc.start()
+        for name, recv in (('recv + copy', recv_copy),
+                           ('pooled recv', lambda mon, batch: recv_pooled(mon, batch, pool))):
+            alloc, usec = run(mon, recv, n, batch)
+            print(f'{name}: {round(alloc)} bytes/pkt allocated, {round(usec, 2)} us/pkt (traced)')
+        tracemalloc.stop()
+        mon.socketfd.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '../src/designed_protocol'))
+from receiver import Recv_bitmap
+
+class Recv_set():
+    """ the receive state the writer used to keep, a set of every seq num still missing """
+    def __init__(self, total:int):
+        self.to_push = set(list(range(total)))
+        self.total   = total
+        self.cum     = 0
+    def add(self, n:int) -> bool:
+        if n not in self.to_push:
+            return False
+        self.to_push.remove(n)
+        while self.cum < self.total and self.cum not in self.to_push:
+            self.cum += 1
+        return True
+
+def arrivals(total:int, span:int=64):
+    """ seq nums in order, shuffled within blocks of `span` like a reordering link """
+    rng = random.Random(0)
+    for start in range(0, total, span):
+        block = list(range(start, min(start + span, total)))
+        rng.shuffle(block)
+        yield from block
+
+def run(make_state, total:int, traced:bool):
+    if traced:
+        tracemalloc.start()
+    start = time.perf_counter()
+    state = make_state(total)
+    for n in arrivals(total):
+        state.add(n)
+    spent = time.perf_counter() - start
+    peak  = 0
+    if traced:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    assert state.cum == total
+    return peak, spent
+
+def main():
+    for total in (10**6, 10**7):
+        for name, make_state in (('set   ', Recv_set), ('bitmap', lambda total: Recv_bitmap())):
+            peak, _  = run(make_state, total, traced=True)
+            _, spent = run(make_state, total, traced=False)
+            print(f'{total:>8} pkts {name}: peak {round(peak / 2**20, 2):>7} MiB '
+                  f'({round(peak * 8 / total, 3)} bits/pkt), {round(spent / total * 1e9)} ns/pkt')
+
+if __name__ == '__main__':
+    main()
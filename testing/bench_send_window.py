@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+from multiprocessing.managers import BaseManager
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '../src/designed_protocol'))
+from com    import Packet
+from sender import Send_window
+
+class Ack_buff():
+    """ the send buffer the sender used to keep, an OrderedDict behind a lock shared through a manager """
+    def __init__(self):
+        self._packets = OrderedDict()
+        self._lock = threading.Lock()
+    def pop(self) -> Packet:
+        val = None
+        with self._lock:
+            if len(self._packets) > 0:
+                val = self._packets.popitem(last=True)[1]
+        return val
+    def get(self, id=None):
+        val = None
+        with self._lock:
+            if len(self._packets) > 0:
+                if id != None:
+                    val = self._packets.get(id, None)
+                elif len(self._packets) > 0:
+                    val = next(iter(self._packets.values()))
+
+            return val
+    def push(self, packet: Packet):
+        with self._lock:
+            self._packets[packet.get_id()] = packet
+    def size(self) -> int:
+        with self._lock:
+            sz = len(self._packets)
+        return sz
+    def remove(self, packet_num:int):
+        # print(f'removing {packet_num}')
+        with self._lock:
+            del_pkt  = self._packets.pop(packet_num, None)
+        return del_pkt
+
+    def cycle(self):
+        with self._lock:
+            if len(self._packets) > 0:
+                pkt = next(iter(self._packets.values()))
+                self._packets.move_to_end(pkt.get_id(), last=True)
+
+def run_ops(buffer, make_packet, n, window):
+    """ push n packets through a buffer of the given window, the way Sender.run/handle_acks do """
+    start = time.perf_counter()
+    for i in range(n):
+        pkt = make_packet(i)
+        buffer.push(pkt)
+        pkt.get_age()
+        if buffer.size() >= window:
+            head = buffer.get()
+            head.get_age()
+            buffer.cycle()
+            buffer.remove(i - window + 1)
+    while buffer.size() > 0:
+        buffer.remove(buffer.get().get_id())
+    return (time.perf_counter() - start) / n
+
+def main():
+    window = 40
+    data   = bytes(1000)
+
+    n = 5000
+    BaseManager.register('Ack_buff', Ack_buff)
+    BaseManager.register('Packet', Packet)
+    manager = BaseManager()
+    manager.start()
+    t_proxy = run_ops(manager.Ack_buff(), lambda i: manager.Packet(((i, n), data)), n, window)
+    manager.shutdown()
+
+    n = 200000
+    t_local = run_ops(Send_window(), lambda i: Packet(((i, n), data)), n, window)
+
+    print(f'managed Ack_buff : {round(t_proxy*1e6, 2)} us/pkt ({round(1/t_proxy)} pkts/sec)')
+    print(f'Send_window      : {round(t_local*1e6, 2)} us/pkt ({round(1/t_local)} pkts/sec)')
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 
+import argparse
 import subprocess as sp
 import threading
 import os
@@ -18,13 +19,19 @@ def parse_sender(cwd):
         gp = float(matches[0])
     else:
         gp =  None
-    matches1 = re.findall(r'Overhead\s*:\s*(\d+)\s*bytes', data)
+    # older logs could carry a negative overhead for compressed transfers
+    matches1 = re.findall(r'Overhead\s*:\s*(-?\d+)\s*bytes', data)
     matches2 = re.findall(r'Total Bytes Transmitted\s*:\s*(\d+)\s*bytes', data)
     if matches1 and matches2:
         oh = int(matches1[0]) / int(matches2[0])
     else:
         oh =  None
-    return (gp, oh)
+    matches = re.findall(r'CPU Time per MB\s*:\s*(\d+\.\d+)\s*secs', data)
+    if matches:
+        cpu = float(matches[0])
+    else:
+        cpu = None
+    return (gp, oh, cpu)
 
 def parse_emulator(cwd):
     f_path = os.path.join(cwd, 'emulator.log')
@@ -33,11 +40,19 @@ def parse_emulator(cwd):
 
     reordered_pkts = data.count('Reordered Packet')
     dropped_pkts   = data.count('Dropped Packet')
-    return (dropped_pkts, reordered_pkts)
+    queue_drops    = sum(int(n) for n in re.findall(r'Dropped (\d+) packets? .* due to full buffer', data))
+    return (dropped_pkts, reordered_pkts, queue_drops)
 
-def run_test(config_file, cwd, log=False):
-    def run_cmd(cmd):
+def run_test(config_file, cwd, log=False, virtual=False):
+    """
+    runs one transfer, returns the wall time each process lived for. A virtual run goes through
+    simulate.py in one process, both lifetimes are then its wall time
+    """
+    lifetimes = {}
+    def run_cmd(name, cmd):
+        start = time.time()
         out = sp.run(cmd, shell=True, stdout=sp.PIPE, stderr=sp.STDOUT, cwd=cwd)
+        lifetimes[name] = time.time() - start
         if log:
             if out.returncode != 0:
                 print('ERROR RUNNING:', out.args)
@@ -46,57 +61,108 @@ def run_test(config_file, cwd, log=False):
             else:
                 print('SUCCESS RUNNING:', out.args)
 
-    commands = [
-        f'python3 ../../emulator/emulator.py {config_file}',
-        f'make run-receiver config={config_file}',
-        f'make run-sender config={config_file}'
-    ]
+    commands = {
+        'emulator': f'python3 ../../emulator/emulator.py {config_file}',
+        'receiver': f'make run-receiver config={config_file}',
+        'sender':   f'make run-sender config={config_file}'
+    }
+    if virtual:
+        commands = {'simulator': f'python3 ../../testing/simulate.py {config_file}'}
 
     threads = []
-    for cmd in commands:
-        thread = threading.Thread(target=run_cmd, args=(cmd,))
+    for name, cmd in commands.items():
+        thread = threading.Thread(target=run_cmd, args=(name, cmd))
         threads.append(thread)
         thread.start()
     for thread in threads:
         thread.join()
+    if virtual:
+        lifetimes['sender'] = lifetimes['receiver'] = lifetimes['simulator']
+    return lifetimes
 
-def main():
-    cfg_name = 'testing_config.ini'
-    cwd      = '../src/stop_and_go'
-    cfg_path = os.path.join('../../test_config/', cfg_name)
-    
-    n = 10
+def benchmark(cfg_path, cwd, n, virtual):
+    """ runs n transfers, prints a summary and returns the results """
     goodputs       = []
     overheads      = []
+    cpu_per_mb     = []
     dropped_pkts   = []
     reordered_pkts = []
+    queue_dropped  = []
+    sender_life    = []
+    receiver_life  = []
     start_time = time.time()
     for i in range(n):
-        run_test(cfg_path, cwd)
+        lifetimes            = run_test(cfg_path, cwd, virtual=virtual)
         time_diff            = time.time() - start_time 
-        gp, oh               = parse_sender(cwd)
-        drop_pkts, rord_pkts = parse_emulator(cwd)
+        gp, oh, cpu          = parse_sender(cwd)
+        drop_pkts, rord_pkts, q_drops = parse_emulator(cwd)
         
         goodputs.append(gp)
         overheads.append(oh)
+        cpu_per_mb.append(cpu)
         dropped_pkts.append(drop_pkts)
         reordered_pkts.append(rord_pkts)
+        queue_dropped.append(q_drops)
+        sender_life.append(lifetimes['sender'])
+        receiver_life.append(lifetimes['receiver'])
         
-        print(f'[{round(time_diff,3)}]: test ({i+1}/{n}) -> {gp} bytes/sec, {round(oh*100,2)} %')
+        oh_str = 'n/a' if oh is None else f'{round(oh*100,2)} %'
+        print(f'[{round(time_diff,3)}]: test ({i+1}/{n}) -> {gp} bytes/sec, {oh_str}, '
+              f'lifetime {round(lifetimes["sender"],2)}/{round(lifetimes["receiver"],2)} secs')
     
     r = lambda x: int(round(x, 0))
     print(f'goodput:  {r(np.mean(goodputs))}[{r(np.std(goodputs))}]')
-    print(f'overhead: {round(np.mean(overheads)*100,2)}[{round(np.std(overheads)*100,2)}]')
+    measured = [oh for oh in overheads if oh is not None]
+    if measured:
+        print(f'overhead: {round(np.mean(measured)*100,2)}[{round(np.std(measured)*100,2)}]')
+    else:
+        print('overhead: n/a')
+    print(f'lifetime: {round(np.mean(sender_life),2)}[{round(np.std(sender_life),2)}] sender, '
+          f'{round(np.mean(receiver_life),2)}[{round(np.std(receiver_life),2)}] receiver')
+
+    return {'goodputs':goodputs,
+            'overheads':overheads,
+            'cpu_per_mb':cpu_per_mb,
+            'dropped_pkts':dropped_pkts,
+            'reordered_pkts':reordered_pkts,
+            'queue_dropped_pkts':queue_dropped,
+            'sender_lifetime':sender_life,
+            'receiver_lifetime':receiver_life
+        }
+
+def main():
+    parser = argparse.ArgumentParser(
+                        prog='benchmark.py',
+                        description='Runs repeated transfers and records goodput, overhead and lifetimes')
+    parser.add_argument('--mode',
+                        choices=['real', 'virtual', 'both'],
+                        default='real',
+                        help='real processes and sockets, a virtual time simulation (simulate.py), or both to compare them')
+    parser.add_argument('-n',
+                        type=int,
+                        default=10,
+                        help='transfers per mode')
+    args = parser.parse_args()
+
+    cfg_name = 'testing_config.ini'
+    cwd      = '../src/stop_and_go'
+    cfg_path = os.path.join('../../test_config/', cfg_name)
+
+    modes = ['real', 'virtual'] if args.mode == 'both' else [args.mode]
+    runs  = {}
+    for mode in modes:
+        print(f'--- {mode} time')
+        runs[mode] = benchmark(cfg_path, cwd, args.n, virtual=(mode == 'virtual'))
+    if args.mode == 'both':
+        real, virtual = (np.mean(runs[mode]['goodputs']) for mode in modes)
+        print(f'virtual goodput is {round((virtual - real) / real * 100, 2)} % off real, '
+              f'{round(np.mean(runs["real"]["sender_lifetime"]) / np.mean(runs["virtual"]["sender_lifetime"]), 1)}x faster')
 
     with open('./test_results.log', 'a') as f:
-        results = {'goodputs':goodputs,
-                    'overheads':overheads,
-                    'dropped_pkts':dropped_pkts,
-                    'reordered_pkts':reordered_pkts
-                }
-        results = {'description':'FILL_ME', 'results':results}
-        f.write(json.dumps(results))
-        f.write('\n')
+        for mode, results in runs.items():
+            results = {'description':'FILL_ME', 'mode':mode, 'results':results}
+            f.write(json.dumps(results))
+            f.write('\n')
 
 if __name__ == '__main__':
     main()
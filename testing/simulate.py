@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+
+import argparse
+import collections
+import functools
+import glob
+import importlib
+import os
+import selectors
+import socket
+import sys
+import threading
+import time
+
+EMULATOR_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '../emulator')
+
+class Virtual_clock():
+    """
+    Discrete event clock shared by every simulated thread. Actors (the sender, the receiver and the
+    emulator's threads) block on it instead of on sockets and timers, and once all of them are blocked
+    the clock jumps to the earliest deadline any of them waits for, so idle time costs nothing. The
+    jump is at least TICK, which lets a thread polling with a zero timeout see time pass. Work done
+    between two waits takes no virtual time.
+    """
+    TICK = 1e-6
+
+    def __init__(self, start:float=0.0):
+        self.now       = start
+        self.stalled   = False
+        self._cond     = threading.Condition()
+        self._n_actors = 0
+        self._blocked  = {}         # waiter -> (ready, deadline)
+    def time(self) -> float:
+        return self.now
+    def join(self):
+        with self._cond:
+            self._n_actors += 1
+    def leave(self):
+        with self._cond:
+            self._n_actors -= 1
+            self._advance()
+    def _wake(self):
+        for waiter, (ready, deadline) in list(self._blocked.items()):
+            if ready() or (deadline is not None and deadline <= self.now):
+                del self._blocked[waiter]
+                self.stalled = False
+        self._cond.notify_all()
+    def _advance(self):
+        if not self._blocked or len(self._blocked) < self._n_actors:
+            return
+        deadlines = [deadline for ready, deadline in self._blocked.values() if deadline is not None]
+        if not deadlines:
+            # every actor waits for something only another actor could do
+            self.stalled = True
+            return
+        self.now = max(min(deadlines), self.now + self.TICK)
+        self._wake()
+    def wait(self, ready, timeout:float=None) -> bool:
+        """ blocks the calling actor until ready() is true or timeout virtual secs pass, returns ready() """
+        with self._cond:
+            if ready():
+                return True
+            waiter = object()
+            self._blocked[waiter] = (ready, None if timeout is None else self.now + max(timeout, 0))
+            self._advance()
+            while waiter in self._blocked:
+                self._cond.wait()
+            return bool(ready())
+    def notify(self, change):
+        """ applies change() to state some actor may be waiting on and wakes whoever it unblocks """
+        with self._cond:
+            change()
+            self._wake()
+
+class Actor(threading.Thread):
+    """ a thread that takes part in virtual time, the clock only moves on once every started actor is blocked """
+    def __init__(self, clock:Virtual_clock, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.daemon = True
+        self.clock  = clock
+        clock.join()
+    def run(self):
+        try:
+            super().run()
+        finally:
+            self.clock.leave()
+
+class Virtual_event():
+    """ threading.Event on the virtual clock """
+    def __init__(self, clock:Virtual_clock):
+        self.clock = clock
+        self._flag = False
+    def is_set(self) -> bool:
+        return self._flag
+    def set(self):
+        self.clock.notify(lambda: setattr(self, '_flag', True))
+    def clear(self):
+        self._flag = False
+    def wait(self, timeout:float=None) -> bool:
+        return self.clock.wait(lambda: self._flag, timeout)
+
+class Virtual_network():
+    """ in-memory loopback, datagrams are in the destination socket's inbox the moment they are sent """
+    def __init__(self, clock:Virtual_clock):
+        self.clock    = clock
+        self._sockets = {}          # port -> Virtual_socket
+    def bind(self, sock):
+        if sock.addr[1] in self._sockets:
+            raise OSError(f'port {sock.addr[1]} is already in use')
+        self._sockets[sock.addr[1]] = sock
+    def unbind(self, sock):
+        self._sockets.pop(sock.addr[1], None)
+    def deliver(self, data:bytes, src, dest):
+        sock = self._sockets.get(dest[1])
+        if sock is not None:
+            self.clock.notify(lambda: sock._inbox.append((data, ('127.0.0.1', src[1]))))
+
+class Virtual_socket():
+    """ the subset of a UDP socket the monitors and the emulator use, on a Virtual_network """
+    def __init__(self, network:Virtual_network):
+        self.network  = network
+        self.clock    = network.clock
+        self.addr     = None
+        self._inbox   = collections.deque()
+        self._timeout = None
+    def bind(self, addr):
+        self.addr = addr
+        self.network.bind(self)
+    def close(self):
+        if self.addr is not None:
+            self.network.unbind(self)
+    def settimeout(self, timeout):
+        self._timeout = timeout
+    def gettimeout(self):
+        return self._timeout
+    def setblocking(self, flag:bool):
+        self._timeout = None if flag else 0.0
+    def sendto(self, data, addr) -> int:
+        self.network.deliver(bytes(data), self.addr, addr)
+        return len(data)
+    def sendmsg(self, buffers, ancdata=(), flags=0, address=None) -> int:
+        return self.sendto(b''.join(buffers), address)
+    def _next(self, flags:int):
+        if not self._inbox:
+            if flags & socket.MSG_DONTWAIT or self._timeout == 0:
+                raise BlockingIOError('no datagram waiting')
+            if not self.clock.wait(lambda: self._inbox, self._timeout):
+                raise socket.timeout('timed out')
+        return self._inbox.popleft()
+    def recvfrom(self, size:int, flags:int=0):
+        data, addr = self._next(flags)
+        return data[:size], addr
+    def recvfrom_into(self, buf, nbytes:int=0, flags:int=0):
+        data, addr = self._next(flags)
+        n = min(len(data), nbytes or len(buf))
+        buf[:n] = data[:n]
+        return n, addr
+
+class Virtual_selector():
+    """ selectors.DefaultSelector over Virtual_sockets, only for reading """
+    def __init__(self, clock:Virtual_clock):
+        self.clock = clock
+        self._keys = []
+    def register(self, sock, events, data=None):
+        key = selectors.SelectorKey(sock, len(self._keys), events, data)
+        self._keys.append(key)
+        return key
+    def select(self, timeout=None):
+        ready = lambda: [key for key in self._keys if key.fileobj._inbox]
+        self.clock.wait(ready, timeout)
+        return [(key, selectors.EVENT_READ) for key in ready()]
+    def close(self):
+        self._keys = []
+
+class Module_shim():
+    """ stands in for a module, overriding some of its attributes and passing the rest through """
+    def __init__(self, module, **overrides):
+        self._module = module
+        self.__dict__.update(overrides)
+    def __getattr__(self, name):
+        return getattr(self._module, name)
+
+def virtualize(module, clock:Virtual_clock, network:Virtual_network):
+    """ points a loaded module's time, socket and selectors at the simulation, CPU clocks stay real """
+    shims = {
+        'time':      Module_shim(time, time=clock.time, monotonic=clock.time,
+                                 sleep=lambda secs: clock.wait(lambda: False, secs)),
+        'socket':    Module_shim(socket, socket=lambda *args, **kwargs: Virtual_socket(network)),
+        'selectors': Module_shim(selectors, DefaultSelector=lambda: Virtual_selector(clock)),
+    }
+    for name, shim in shims.items():
+        if getattr(module, name, None) is sys.modules[name]:
+            setattr(module, name, shim)
+    if hasattr(module, 'START_TIME'):
+        module.START_TIME = clock.time()
+
+def load_endpoint(protocol_dir:str, prefix:str):
+    """ imports the one sender*.py / receiver*.py in the protocol directory """
+    paths = glob.glob(os.path.join(protocol_dir, f'{prefix}*.py'))
+    if len(paths) != 1:
+        raise SystemExit(f'expected one {prefix}*.py in {protocol_dir}, found {len(paths)}')
+    return importlib.import_module(os.path.splitext(os.path.basename(paths[0]))[0])
+
+def simulate(cfg_path:str, protocol_dir:str) -> float:
+    """ runs the emulator, receiver and sender of one transfer in virtual time, returns the virtual secs it took """
+    sys.path.insert(0, os.path.abspath(protocol_dir))
+    sys.path.insert(0, os.path.abspath(EMULATOR_DIR))
+    import emulator
+    sender_mod   = load_endpoint(protocol_dir, 'sender')
+    receiver_mod = load_endpoint(protocol_dir, 'receiver')
+
+    clock   = Virtual_clock(start=time.time())
+    network = Virtual_network(clock)
+    for module in list(sys.modules.values()):
+        path = getattr(module, '__file__', None) or ''
+        if os.path.dirname(os.path.abspath(path)) in (os.path.abspath(protocol_dir), os.path.abspath(EMULATOR_DIR)):
+            virtualize(module, clock, network)
+    emulator.Thread = functools.partial(Actor, clock)
+
+    emulator.read_config_file(cfg_path)
+    ne = emulator.NetworkEmulator(host=emulator.HOST, port=emulator.PORT, num_NODES=len(emulator.nodes))
+    ne.latency_queue._wakeup = Virtual_event(clock)
+    receiver = receiver_mod.Receiver(cfg_path)
+    sender   = sender_mod.Sender(cfg_path)
+
+    start   = clock.time()
+    actors  = [Actor(clock, target=ne.run), Actor(clock, target=receiver.run), Actor(clock, target=sender.run)]
+    for actor in actors:
+        actor.start()
+    stalls = 0
+    for actor in actors[1:]:
+        while actor.is_alive():
+            actor.join(0.5)
+            stalls = stalls + 1 if clock.stalled else 0
+            if stalls > 1:
+                print(f'simulation stalled {round(clock.time() - start, 3)} virtual secs in, every thread is waiting without a timeout')
+                return clock.time() - start
+    return clock.time() - start
+
+def main():
+    parser = argparse.ArgumentParser(
+                        prog='simulate.py',
+                        description='Runs a transfer through the emulator in virtual time, in one process with in-memory sockets')
+    parser.add_argument('config_path',
+                        type=str,
+                        help='path of the config file')
+    parser.add_argument('--protocol',
+                        type=str,
+                        default='.',
+                        help='directory with the sender*.py and receiver*.py to run (default: the current one)')
+    args = parser.parse_args()
+
+    wall_start = time.time()
+    virtual    = simulate(args.config_path, args.protocol)
+    wall       = time.time() - wall_start
+    print(f'simulated {round(virtual, 3)} secs in {round(wall, 3)} secs of wall time ({round(virtual / wall, 1)}x)')
+
+if __name__ == '__main__':
+    main()